@@ -28,12 +28,22 @@ See Davis weatherlink-live-local-api
 
 from __future__ import with_statement
 
+import array
+import gzip
+import os
+import queue
+import selectors
 import socket
-from socket import AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_BROADCAST
+import stat
+import struct
+import threading
+from socket import AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_BROADCAST, SO_RCVBUF, SO_REUSEADDR, IPPROTO_IP, \
+    IP_MULTICAST_TTL
 import time
 
 import requests
 import json
+import math
 
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
@@ -48,11 +58,8 @@ DRIVER_VERSION = '0.2.9'
 
 MM2INCH = 1 / 25.4
 
-# Open UDP Socket
-comsocket = socket.socket(AF_INET, SOCK_DGRAM)
-comsocket.bind(('', 22222))
-comsocket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-comsocket.settimeout(5)
+# Seconds without a UDP datagram before the broadcast is requested again
+UDP_TIMEOUT = 5
 
 try:
     # Test for WeeWX v4 logging
@@ -93,17 +100,88 @@ except ImportError:
         logmsg(syslog.LOG_ERR, msg)
 
 
+# JSON decoders by name, fastest first. orjson and ujson are optional.
+JSON_BACKENDS = dict()
+try:
+    import orjson
+
+    JSON_BACKENDS['orjson'] = orjson.loads
+except ImportError:
+    pass
+try:
+    import ujson
+
+    JSON_BACKENDS['ujson'] = ujson.loads
+except ImportError:
+    pass
+JSON_BACKENDS['json'] = json.loads
+
+# paho-mqtt is optional, it is only needed for MqttSink
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+# Parses a UDP datagram or HTTP body straight from bytes, see set_json_backend()
+parse_json = next(iter(JSON_BACKENDS.values()))
+
+
+def set_json_backend(name='auto'):
+    """Select the decoder behind parse_json(); 'auto' picks the fastest one installed."""
+    global parse_json
+    if name == 'auto':
+        name = next(iter(JSON_BACKENDS))
+    elif name not in JSON_BACKENDS:
+        logerr('JSON backend {} is not installed, using {}'.format(name, next(iter(JSON_BACKENDS))))
+        name = next(iter(JSON_BACKENDS))
+    parse_json = JSON_BACKENDS[name]
+    logdbg('JSON backend is {}'.format(name))
+    return name
+
+
 def loader(config_dict, engine):
-    return WeatherLinkLiveUDPDriver(**config_dict[DRIVER_NAME])
+    stn_dict = dict(config_dict[DRIVER_NAME])
+    if 'state_file' not in stn_dict and 'WEEWX_ROOT' in config_dict:
+        # Keep the rain state next to the SQLite databases
+        sqlite_root = config_dict.get('DatabaseTypes', {}).get('SQLite', {}).get('SQLITE_ROOT', 'archive')
+        stn_dict['state_file'] = os.path.join(config_dict['WEEWX_ROOT'], sqlite_root, 'weatherlinkliveudp.state')
+    return WeatherLinkLiveUDPDriver(**stn_dict)
+
+
+def save_json(path, data):
+    """Write data to path as JSON, atomically by replacing the file."""
+    temp_file = path + '.tmp'
+    with open(temp_file, 'w') as json_file:
+        json.dump(data, json_file)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(temp_file, path)
+
 
 class RainBarrel:
-    def __init__(self):
+    def __init__(self, state_file=None):
         self.bucketsize = 0.0
-        self.rain_previous_period = 0
+        # Transmitter whose daily rain counter is tracked
+        self.txid = None
+        # None until the daily rain counter of the WLL is known
+        self.rain_previous_period = None
         self.previous_day = None
+        # Epoch of the next midnight, when the daily rain counter resets
+        self.previous_date_stamp = None
+        # Time of the newest data record whose counter was accounted for
+        self.last_ts = None
 
         self.rain = 0
 
+        # Checkpoint of the state above, see save_state()
+        self.state_file = state_file
+        # A rain tip only marks the state dirty; flush() saves it at most
+        # every save_interval seconds, off the receive path
+        self.save_interval = 60
+        self.dirty = False
+        self.next_save = 0.0
+        self.lock = threading.Lock()
+
     # rain collector type/size **(0: Reserved, 1: 0.01", 2: 0.2 mm, 3:  0.1 mm, 4: 0.001")*
     def set_up_bucket_size(self, data):
 
@@ -128,6 +206,7 @@ class RainBarrel:
 
     def set_rain_previous_period(self, data):
         self.rain_previous_period = data
+        self.save_state()
         logdbg('({}) Previous rain is set at: {} buckets [{} mm / {} in]'
                .format(weeutil.weeutil.timestamp_to_string(time.time()),
                        (self.rain_previous_period),
@@ -137,224 +216,1564 @@ class RainBarrel:
     def empty_rain_barrel(self):
         self.rain = 0
 
-    def set_rain_previous_date(self, data):
-        # Setting the current date to Midnight for rain reset
-        data += datetime.timedelta(days=1)
-        data = data.replace(hour=0, minute=0, second=0, microsecond=0)
-        self.previous_date_stamp = data
+    def set_rain_previous_date(self, ts):
+        # Setting the next Midnight after ts for rain reset
+        day = datetime.date.fromtimestamp(ts) + datetime.timedelta(days=1)
+        self.previous_date_stamp = time.mktime(day.timetuple())
+        self.save_state()
         logdbg('({}) Rain daily reset: {}'
                .format(weeutil.weeutil.timestamp_to_string(time.time()),
-                       str(self.previous_date_stamp)))
-
-
-class WllStation:
-    def __init__(self):
-        self.poll_interval = 10
-        self.txid_iss = None
-        self.extra1 = None
+                       weeutil.weeutil.timestamp_to_string(self.previous_date_stamp)))
+
+    def save_state(self):
+        """Checkpoint the barrel to state_file, atomically by replacing it."""
+        if not self.state_file or self.rain_previous_period is None or self.previous_date_stamp is None:
+            return
+        # The poller thread flushes, the driver loop saves at midnight
+        with self.lock:
+            self.dirty = False
+            self.next_save = time.monotonic() + self.save_interval
+            state = {
+                'txid': self.txid,
+                'bucketsize': self.bucketsize,
+                'rain_previous_period': self.rain_previous_period,
+                'previous_date_stamp': self.previous_date_stamp,
+                'last_ts': self.last_ts,
+                'saved': time.time(),
+            }
+            try:
+                save_json(self.state_file, state)
+            except (IOError, OSError) as err:
+                logerr('Unable to save rain state to {}: {}'.format(self.state_file, err))
+
+    def flush(self, now=None):
+        """Save the state when it changed and save_interval passed since the last save."""
+        now = time.monotonic() if now is None else now
+        if self.dirty and now >= self.next_save:
+            self.save_state()
+
+    def load_state(self):
+        """Restore the barrel from state_file. Returns True when it was restored."""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return False
+        try:
+            with open(self.state_file) as state_file:
+                state = json.load(state_file)
+            self.txid = state['txid']
+            self.bucketsize = float(state['bucketsize'])
+            self.rain_previous_period = state['rain_previous_period']
+            self.previous_date_stamp = float(state['previous_date_stamp'])
+            self.last_ts = state.get('last_ts')
+        except (IOError, OSError, ValueError, KeyError, TypeError) as err:
+            logerr('Unable to restore rain state from {}: {}'.format(self.state_file, err))
+            return False
+        loginf('Restored rain state from {}: {} buckets until {}'
+               .format(self.state_file, self.rain_previous_period,
+                       weeutil.weeutil.timestamp_to_string(self.previous_date_stamp)))
+        return True
+
+
+# Plausible (min, max) of the fields, in US units
+QUALITY_RANGES = {
+    'outTemp': (-60, 140),
+    'inTemp': (-20, 140),
+    'extraTemp1': (-60, 140),
+    'dewpoint': (-100, 140),
+    'inDewpoint': (-100, 140),
+    'heatindex': (-60, 200),
+    'windchill': (-150, 140),
+    'outHumidity': (0, 100),
+    'inHumidity': (0, 100),
+    'extraHumid1': (0, 100),
+    'pressure': (15, 35),
+    'altimeter': (25, 35),
+    'windSpeed': (0, 200),
+    'windDir': (0, 360),
+    'windGust': (0, 250),
+    'windGustDir': (0, 360),
+    'rainRate': (0, 100),
+    'radiation': (0, 2000),
+    'UV': (0, 25),
+    'soilTemp1': (-40, 150),
+    'soilTemp2': (-40, 150),
+    'soilTemp3': (-40, 150),
+    'soilTemp4': (-40, 150),
+    'soilMoist1': (0, 200),
+    'soilMoist2': (0, 200),
+    'soilMoist3': (0, 200),
+    'soilMoist4': (0, 200),
+    'leafWet1': (0, 15),
+    'leafWet2': (0, 15),
+}
+
+# Largest plausible change per minute of the slowly changing fields
+QUALITY_RATES = {
+    'outTemp': 3.0,
+    'inTemp': 3.0,
+    'extraTemp1': 3.0,
+    'outHumidity': 15.0,
+    'inHumidity': 15.0,
+    'extraHumid1': 15.0,
+    'pressure': 0.05,
+    'altimeter': 0.05,
+    'soilTemp1': 1.0,
+    'soilTemp2': 1.0,
+    'soilTemp3': 1.0,
+    'soilTemp4': 1.0,
+}
+
+
+class FieldHistory:
+    """Last accepted value of a field, with its exponentially weighted mean and variance."""
+
+    __slots__ = ('ts', 'value', 'mean', 'var', 'rejects')
+
+    def __init__(self, ts, value):
+        self.ts = ts
+        self.value = value
+        self.mean = value
+        self.var = 0.0
+        self.rejects = 0
+
+
+class QualityFilter:
+    """Drops implausible values from decoded packets.
+
+    A value outside its range is dropped. A value that changes faster than
+    its rate limit (per minute) and lies more than spread standard deviations
+    from the running mean of the field is dropped as a spike. The running mean
+    and variance are exponentially weighted, so each value costs O(1). After
+    max_rejects spikes in a row the new level is accepted and the running
+    statistics start over from it. None values are left
+    alone. Dropped values are counted per field, not logged.
+    """
 
-        self.davis_date_stamp = None
-        self.system_date_stamp = None
+    def __init__(self, ranges=None, rates=None, spread=4.0, alpha=0.1, max_rejects=3, stats=None):
+        self.ranges = dict(QUALITY_RANGES)
+        for field, limits in (ranges or dict()).items():
+            self.ranges[field] = (float(limits[0]), float(limits[1]))
+        self.rates = dict(QUALITY_RATES)
+        for field, rate in (rates or dict()).items():
+            self.rates[field] = float(rate)
+        self.spread = spread
+        self.alpha = alpha
+        self.max_rejects = max_rejects
+        self.stats = stats if stats is not None else DriverStats()
+
+        self.history = dict()
+        self.rejected = dict()
+
+    def check(self, ts, packet):
+        """Remove the implausible values from packet, a packet of time ts."""
+        ranges = self.ranges
+        rates = self.rates
+        rejected = None
+        for field, value in packet.items():
+            limits = ranges.get(field)
+            if limits is None or value is None:
+                continue
+            if not limits[0] <= value <= limits[1] or (field in rates and self.is_spike(field, ts, value)):
+                if rejected is None:
+                    rejected = []
+                rejected.append(field)
+        if rejected is not None:
+            for field in rejected:
+                self.reject(field, packet)
+
+    def is_spike(self, field, ts, value):
+        history = self.history.get(field)
+        if history is None:
+            self.history[field] = FieldHistory(ts, value)
+            return False
 
-        self.real_rime_url = None
-        self.current_conditions_url = None
+        minutes = (ts - history.ts) / 60.0
+        if (minutes > 0 and abs(value - history.value) > self.rates[field] * minutes
+                and abs(value - history.mean) > self.spread * math.sqrt(history.var)):
+            if history.rejects < self.max_rejects:
+                history.rejects += 1
+                return True
+            # Not a spike but a new level, e.g. after a sensor swap
+            self.history[field] = FieldHistory(ts, value)
+            return False
 
-        self.davis_packet = dict()
-        self.davis_packet['rain'] = 0
-        self.udp_countdown = 0
+        # Exponentially weighted mean and variance
+        diff = value - history.mean
+        increment = self.alpha * diff
+        history.mean += increment
+        history.var = (1 - self.alpha) * (history.var + diff * increment)
+        history.ts = ts
+        history.value = value
+        history.rejects = 0
+        return False
 
-    rainbarrel = RainBarrel()
+    def reject(self, field, packet):
+        del packet[field]
+        self.rejected[field] = self.rejected.get(field, 0) + 1
+        self.stats.count('values_rejected')
 
-    def set_poll_interval(self, data):
-        self.poll_interval = data
-        if self.poll_interval < 10:
-            logerr('Unable to set Poll Interval (minimal 10 s.)')
-        loginf('HTTP polling interval is %s' % self.poll_interval)
 
-    def set_txid(self, data):
-        if data:
-            self.txid_iss = int(data)
-            loginf('tx id of ISS is {}'.format(self.txid_iss))
+class WindWindow:
+    """Running sums over the wind samples of the last seconds seconds.
 
-    def set_extra1(self, data):
-        if data:
-            self.extra1 = int(data)
-            loginf('Extra sensor is using id: {}'.format(self.extra1))
+    The samples form a contiguous run of the WindSampler ring that ends at the
+    newest sample and starts at tail.
+    """
 
-    def decode_data_wll(self, data):
+    __slots__ = ('seconds', 'tail', 'count', 'speed', 'speed2', 'u', 'v', 'gust_index')
 
-        iss_data = None
-        leaf_soil_data = None
-        lss_bar_data = None
-        lss_temp_hum_data = None
-        iss_udp_data = None
-        extra_data1 = None
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.tail = 0
+        self.gust_index = -1
+        self.reset()
 
-        self.current_davis_data = data
+    def reset(self):
+        self.count = 0
+        self.speed = 0.0
+        self.speed2 = 0.0
+        self.u = 0.0
+        self.v = 0.0
+        self.gust_index = -1
 
-        timestamp = data['ts']
-        self.davis_date_stamp = datetime.datetime.fromtimestamp(timestamp)
-        self.system_date_stamp = datetime.datetime.now()
 
-        packet = dict()
+class WindSampler:
+    """Ring buffer of the UDP wind samples with rolling gust, average,
+    vector-averaged direction and standard deviation.
 
-        packet['dateTime'] = timestamp
-        packet['usUnits'] = weewx.US
-
-        for condition in data['conditions']:
-            # 1 = ISS Current Conditions record
-            # 2 = Leaf/Soil Moisture Current Conditions record
-            # 3 = LSS BAR Current Conditions record
-            # 4 = LSS Temp/Hum Current Conditions record
+    The samples are kept in preallocated arrays and every window keeps running
+    sums, so adding a sample only updates the sums of the samples entering and
+    leaving the windows. The ring must hold at least the longest window worth
+    of samples (600 s at 2.5 s is 240 samples).
+    """
 
-            if condition.get('txid') == self.txid_iss and condition.get('data_structure_type') == 1:
-                iss_data = condition
-            if condition.get('data_structure_type') == 2:
-                leaf_soil_data = condition
+    def __init__(self, size=256, gust_window=120, avg_window=600):
+        self.size = size
+        self.ts = array.array('d', bytes(8 * size))
+        self.speed = array.array('d', bytes(8 * size))
+        self.direction = array.array('d', bytes(8 * size))
+        self.u = array.array('d', bytes(8 * size))
+        self.v = array.array('d', bytes(8 * size))
+        self.head = 0
+        self.length = 0
+
+        self.gust = WindWindow(gust_window)
+        self.average = WindWindow(avg_window)
+        self.windows = (self.gust, self.average)
+
+    def push(self, ts, speed, direction):
+        if speed is None or direction is None:
+            return
+        index = self.head
+        if self.length == self.size:
+            # The oldest sample is overwritten, take it out of the windows first
+            for window in self.windows:
+                if window.count and window.tail == index:
+                    self.evict(window)
+        else:
+            self.length += 1
+
+        radians = math.radians(direction)
+        u = speed * math.sin(radians)
+        v = speed * math.cos(radians)
+        self.ts[index] = ts
+        self.speed[index] = speed
+        self.direction[index] = direction
+        self.u[index] = u
+        self.v[index] = v
+        self.head = (index + 1) % self.size
+
+        for window in self.windows:
+            if not window.count:
+                window.tail = index
+            window.count += 1
+            window.speed += speed
+            window.speed2 += speed * speed
+            window.u += u
+            window.v += v
+            if window.gust_index < 0 or speed >= self.speed[window.gust_index]:
+                window.gust_index = index
+            cutoff = ts - window.seconds
+            while window.count and self.ts[window.tail] <= cutoff:
+                self.evict(window)
+
+    def evict(self, window):
+        index = window.tail
+        window.tail = (index + 1) % self.size
+        window.count -= 1
+        if not window.count:
+            window.reset()
+            return
+        speed = self.speed[index]
+        window.speed -= speed
+        window.speed2 -= speed * speed
+        window.u -= self.u[index]
+        window.v -= self.v[index]
+        if index == window.gust_index:
+            # The gust left the window, find the highest speed that is left
+            gust_index = window.tail
+            for offset in range(1, window.count):
+                candidate = (window.tail + offset) % self.size
+                if self.speed[candidate] >= self.speed[gust_index]:
+                    gust_index = candidate
+            window.gust_index = gust_index
+
+    def summary(self, window):
+        """(gust, gust direction, average speed, vector-averaged direction, speed standard deviation)"""
+        if not window.count:
+            return None, None, None, None, None
+        mean = window.speed / window.count
+        deviation = math.sqrt(max(window.speed2 / window.count - mean * mean, 0.0))
+        direction = None
+        if window.u or window.v:
+            direction = math.degrees(math.atan2(window.u, window.v)) % 360
+        return (self.speed[window.gust_index], self.direction[window.gust_index],
+                mean, direction, deviation)
+
+    def update_packet(self, ts, packet):
+        """Add a UDP packet's wind sample and set its gust and average fields."""
+        self.push(ts, packet.get('windSpeed'), packet.get('windDir'))
+        gust, gust_dir, _, _, _ = self.summary(self.gust)
+        if gust is not None:
+            packet['windGust'] = gust
+            packet['windGustDir'] = gust_dir
+        _, _, speed, direction, _ = self.summary(self.average)
+        if speed is not None:
+            packet['windSpeed10'] = speed
+            packet['windDir10'] = direction
+
+    def as_dict(self):
+        stats = dict()
+        for name, window in (('gust', self.gust), ('average', self.average)):
+            gust, gust_dir, speed, direction, deviation = self.summary(window)
+            stats[name] = {'seconds': window.seconds, 'samples': window.count, 'gust': gust,
+                           'gust_dir': gust_dir, 'speed': speed, 'dir': direction, 'stddev': deviation}
+        return stats
+
+
+# Data structure types of the condition records
+ISS_CURRENT_CONDITIONS = 1
+LEAF_SOIL_CURRENT_CONDITIONS = 2
+LSS_BAR_CURRENT_CONDITIONS = 3
+LSS_TEMP_HUM_CURRENT_CONDITIONS = 4
+
+# (packet field, WLL field) pairs per record type
+ISS_HTTP_FIELDS = (
+    # most recent valid wind speed **(mph)**
+    ('windSpeed', 'wind_speed_last'),
+    # most recent valid wind direction **(degree)**
+    ('windDir', 'wind_dir_last'),
+    # maximum wind speed over last 2 min **(mph)**
+    ('windGust', 'wind_speed_hi_last_2_min'),
+    # gust wind direction over last 2 min **(degree)**
+    ('windGustDir', 'wind_dir_at_hi_speed_last_2_min'),
+    # wind speed and direction average for the last 10 minutes
+    # (not recorded in archive but used elsewhere)
+    ('windSpeed10', 'wind_speed_avg_last_10_min'),
+    ('windDir10', 'wind_dir_scalar_avg_last_10_min'),
+    # most recent valid temperature **(F)**
+    ('outTemp', 'temp'),
+    # most recent valid humidity **(%RH)**
+    ('outHumidity', 'hum'),
+    # **(F)**
+    ('dewpoint', 'dew_point'),
+    ('heatindex', 'heat_index'),
+    ('windchill', 'wind_chill'),
+    ('THSW', 'thsw_index'),
+    ('outWetbulb', 'wet_bulb'),
+    # most recent solar radiation **(W/m)**
+    ('radiation', 'solar_rad'),
+    # most recent UV index **(Index)**
+    ('UV', 'uv_index'),
+    # transmitter battery status flag **(no unit)**
+    ('txBatteryStatus', 'trans_battery_flag'),
+    # configured radio receiver state **(no unit)**
+    ('signal1', 'rx_state'),
+)
+
+# The 2.5 s broadcast only carries wind and rain
+ISS_UDP_FIELDS = (
+    ('windSpeed', 'wind_speed_last'),
+    ('windDir', 'wind_dir_last'),
+)
+
+LSS_BAR_FIELDS = (
+    # most recent bar sensor reading with elevation adjustment **(inches)**
+    ('altimeter', 'bar_sea_level'),
+    ('pressure', 'bar_absolute'),
+)
+
+LSS_TEMP_HUM_FIELDS = (
+    # most recent valid inside temp **(F)**
+    ('inTemp', 'temp_in'),
+    # most recent valid inside humidity **(%RH)**
+    ('inHumidity', 'hum_in'),
+    # **(F)**
+    ('inDewpoint', 'dew_point_in'),
+)
+
+EXTRA_FIELDS = (
+    ('extraTemp1', 'temp'),
+    ('extraHumid1', 'hum'),
+)
+
+
+# Default mapping of the first Leaf/Soil transmitter
+LEAF_SOIL_FIELDS = (
+    ('soilTemp1', 'temp_1'),
+    ('soilTemp2', 'temp_2'),
+    ('soilTemp3', 'temp_3'),
+    ('soilTemp4', 'temp_4'),
+    ('soilMoist1', 'moist_soil_1'),
+    ('soilMoist2', 'moist_soil_2'),
+    ('soilMoist3', 'moist_soil_3'),
+    ('soilMoist4', 'moist_soil_4'),
+    ('leafWet1', 'wet_leaf_1'),
+    ('leafWet2', 'wet_leaf_2'),
+)
+
+
+class DecodeSpec:
+    """How to copy one condition record into a LOOP packet.
+
+    The (field, key) lists are built once per record type, so decoding a
+    record costs no key probing beyond the fields it actually copies. Optional
+    fields are copied from both HTTP and UDP records when the record reports them.
+    """
 
-            if condition.get('data_structure_type') == 3:
-                lss_bar_data = condition
+    __slots__ = ('http_fields', 'udp_fields', 'optional_fields', 'rain')
 
-            if condition.get('data_structure_type') == 4:
-                lss_temp_hum_data = condition
+    def __init__(self, http_fields=(), udp_fields=(), rain=False, optional_fields=()):
+        self.http_fields = tuple(http_fields)
+        self.udp_fields = tuple(udp_fields)
+        self.optional_fields = tuple(optional_fields)
+        # Record carries the daily rain counter of the main ISS
+        self.rain = rain
 
-            if condition.get('txid') == self.txid_iss and condition.get(
-                    'data_structure_type') == 1 and not condition.get('temp'):
-                iss_udp_data = condition
+    def extend(self, optional_fields):
+        return DecodeSpec(self.http_fields, self.udp_fields, self.rain, self.optional_fields + tuple(optional_fields))
 
-            # If extra sensor are requested, try to find them
-            if self.extra1 and condition.get('txid') == self.extra1:
-                extra_data1 = condition
+    def extract(self, condition, packet, udp=False):
+        for field, key in self.udp_fields if udp else self.http_fields:
+            packet[field] = condition[key]
+        for field, key in self.optional_fields:
+            value = condition.get(key)
+            if value is not None:
+                packet[field] = value
 
-        # Get UDP data
-        if iss_udp_data:
 
-            # most recent valid wind speed **(mph)**
-            packet['windSpeed'] = iss_udp_data['wind_speed_last']
+class LatencyHistogram:
+    """Durations of one stage, in power of two microsecond buckets."""
 
-            # most recent valid wind direction **(degree)**
-            packet['windDir'] = iss_udp_data['wind_dir_last']
+    __slots__ = ('count', 'total', 'max', 'buckets')
 
-            # Rain
-            ## Fix: Check for NoneType
-            self.rainbarrel.rain = iss_udp_data['rainfall_daily']
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # Bucket n holds durations of 2**(n-1) up to 2**n us
+        self.buckets = [0] * 40
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[int(seconds * 1000000).bit_length()] += 1
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, in seconds."""
+        remaining = self.count * p / 100.0
+        for index, count in enumerate(self.buckets):
+            remaining -= count
+            if remaining <= 0 and count:
+                return min(2 ** index / 1000000.0, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            'p50_ms': round(self.percentile(50) * 1000, 3),
+            'p90_ms': round(self.percentile(90) * 1000, 3),
+            'p99_ms': round(self.percentile(99) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+
+# Instrumented stages of the driver loop
+STAT_STAGES = ('http_request', 'udp_receive', 'json_parse', 'decode', 'calculate_rain',
+               'udp_yield_latency', 'http_yield_latency', 'engine_stall', 'broadcast_renewal')
+STAT_COUNTERS = ('udp_datagrams', 'udp_decoded', 'udp_timeouts', 'json_errors',
+                 'broadcast_renewals', 'broadcast_renewal_failures', 'packets_coalesced',
+                 'values_rejected', 'rain_counter_resets', 'packets_unchanged', 'http_results_dropped', 'http_results_replaced',
+                 'udp_unknown_source', 'rediscoveries', 'packets_out_of_order',
+                 'rain_records_stale')
+
+
+class DriverStats:
+    """Counters and latency histograms of the driver.
+
+    Recording is kept to a perf_counter() difference and a histogram add:
+        start = time.perf_counter()
+        ...
+        stats.decode.add(time.perf_counter() - start)
+    Other components register gauges, callables that are read when a
+    snapshot is taken.
+    """
 
-            if iss_udp_data['rain_rate_last'] is None:
-                logdbg("Error: UDP->rain_rate_last not defined")
-            else:
-                packet['rainRate'] = iss_udp_data['rain_rate_last'] * self.rainbarrel.bucketsize
+    def __init__(self):
+        self.started = time.time()
+        self.counters = dict.fromkeys(STAT_COUNTERS, 0)
+        self.stages = dict()
+        for stage in STAT_STAGES:
+            self.stages[stage] = LatencyHistogram()
+            setattr(self, stage, self.stages[stage])
+        self.gauges = dict()
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def snapshot(self):
+        snapshot = {
+            'uptime': round(time.time() - self.started, 1),
+            'counters': dict(self.counters),
+            'stages': dict((stage, histogram.as_dict()) for stage, histogram in self.stages.items()),
+            'gauges': dict(),
+        }
+        for name, gauge in self.gauges.items():
+            try:
+                snapshot['gauges'][name] = gauge()
+            except Exception as err:
+                snapshot['gauges'][name] = str(err)
+        return snapshot
+
+    def summary(self):
+        counters = ', '.join('{}={}'.format(name, value) for name, value in sorted(self.counters.items()))
+        stages = ', '.join('{} {}x avg {:.2f} ms max {:.2f} ms'
+                           .format(stage, histogram.count, histogram.total / histogram.count * 1000,
+                                   histogram.max * 1000)
+                           for stage, histogram in self.stages.items() if histogram.count)
+        return '{}; {}'.format(counters, stages)
+
+
+class StatsServer:
+    """Read-only endpoint that answers with a JSON snapshot of DriverStats.
+
+    Listens on 127.0.0.1:port for HTTP GET and/or on a Unix socket, where each
+    connection gets the snapshot and is closed.
+    """
 
-            self.calculate_rain()
+    def __init__(self, stats, port=0, path=None):
+        self.stats = stats
+        self.port = port
+        self.path = path
+        self.servers = []
+
+    def start(self):
+        import http.server
+        import socketserver
+
+        stats = self.stats
+
+        if self.port:
+            class HttpHandler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    content = json.dumps(stats.snapshot(), indent=2).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.servers.append(http.server.ThreadingHTTPServer(('127.0.0.1', self.port), HttpHandler))
+            loginf('Driver stats on http://127.0.0.1:{}/'.format(self.port))
+
+        if self.path and not self.remove_socket():
+            logerr('{} is not a socket, not serving driver stats on it'.format(self.path))
+            self.path = None
+
+        if self.path:
+            class UnixHandler(socketserver.StreamRequestHandler):
+                def handle(self):
+                    self.wfile.write(json.dumps(stats.snapshot()).encode('utf-8') + b'\n')
+
+            self.servers.append(socketserver.ThreadingUnixStreamServer(self.path, UnixHandler))
+            loginf('Driver stats on unix socket {}'.format(self.path))
+
+        for server in self.servers:
+            server.daemon_threads = True
+            thread = threading.Thread(target=server.serve_forever, name='WLL stats')
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+        if self.path:
+            self.remove_socket()
+
+    def remove_socket(self):
+        """Remove a stale socket at path. False when path is another kind of file."""
+        try:
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                return False
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        return True
+
+
+class WllHttpClient:
+    """HTTP client owned by the driver.
+
+    One requests Session is kept for the lifetime of the driver, so polls to the
+    WLL reuse the same keep-alive connection instead of doing a fresh TCP
+    handshake every time.
+    """
 
-            packet['rain'] = self.davis_packet['rain']
+    def __init__(self, pool_size=1, timeout=3, retries=3, backoff_factor=1, hosts=1, stats=None):
+        self.timeout = timeout
+        self.stats = stats if stats is not None else DriverStats()
+
+        retry_strategy = Retry(total=retries, backoff_factor=backoff_factor)
+        # One pool of pool_size connections per WLL
+        self.adapter = HTTPAdapter(pool_connections=hosts,
+                                   pool_maxsize=pool_size,
+                                   max_retries=retry_strategy)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+
+        self.requests = 0
+        self.failures = 0
+        # Optional PayloadRecorder for the raw responses
+        self.recorder = None
+        # urllib3 connection pools used so far, keyed by id
+        self._pools = dict()
 
-            if packet['rain'] > 0:
-                logdbg('UDP rain detect: {} buckets -> {} in'
-                       .format(self.davis_packet['rain'] / self.rainbarrel.bucketsize,
-                               self.davis_packet['rain']))
+    @property
+    def connections_new(self):
+        return sum(pool.num_connections for pool in self._pools.values())
 
-        # Get HTTP data
-        if iss_data and iss_data.get('temp'):
-            # most recent valid wind speed **(mph)**
-            packet['windSpeed'] = iss_data['wind_speed_last']
+    @property
+    def connections_reused(self):
+        return sum(pool.num_requests - pool.num_connections for pool in self._pools.values())
+
+    def request(self, url, record_as='http'):
+        self.requests += 1
+        try:
+            start = time.perf_counter()
+            resp = self.session.get(url, timeout=self.timeout)
+            self.stats.http_request.add(time.perf_counter() - start)
+            if self.recorder is not None:
+                self.recorder.record(record_as, resp.content)
+
+            pool = getattr(resp.raw, '_pool', None)
+            if pool is not None:
+                self._pools[id(pool)] = pool
+
+            start = time.perf_counter()
+            json_data = parse_json(resp.content)
+            self.stats.json_parse.add(time.perf_counter() - start)
+            if json_data["data"] is None:
+                logerr(json_data["error"])
+            else:
+                return json_data
+        except requests.Timeout as err:
+            logerr({"message": err})
+        except requests.RequestException as err:
+            # Max retries exceeded
+            logerr('Request Exception: {}'.format(err))
+        except ValueError:
+            self.stats.count('json_errors')
+            logerr('Response was ignored because it was not valid JSON.')
+        self.failures += 1
+
+    def close(self):
+        logdbg('HTTP requests: {}, failed: {}, new connections: {}, reused connections: {}'
+               .format(self.requests, self.failures, self.connections_new, self.connections_reused))
+        self.session.close()
+
+
+# Capture record: receive time, source, payload length, followed by the payload
+CAPTURE_RECORD = struct.Struct('<dBI')
+CAPTURE_SOURCES = ('http', 'udp', 'real_time')
+
+
+class PayloadRecorder:
+    """Appends raw HTTP responses and UDP datagrams to a compressed capture.
+
+    The capture is a gzip file of CAPTURE_RECORD headers, each followed by the
+    raw payload. Records are handed to a background writer thread, so recording
+    never blocks the receive path; when the queue is full the record is dropped
+    and counted. The file is rotated to <path>.1 .. <path>.<backups> once it
+    grows past max_bytes.
+    """
 
-            # most recent valid wind direction **(degree)**
-            packet['windDir'] = iss_data['wind_dir_last']
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5, queue_size=10000, flush_interval=10):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+
+        self.queue = queue.Queue(queue_size)
+        self.recorded = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self.run, name='WLL recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, source, payload, ts=None):
+        try:
+            self.queue.put_nowait((time.time() if ts is None else ts, source, payload))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # A writer that stopped on an error no longer empties the queue
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=5)
+            except queue.Full:
+                logerr('Recorder of {} does not keep up, stopping it'.format(self.path))
+            self.thread.join(10)
+        logdbg('Recorded {} payloads to {}, dropped {}'.format(self.recorded, self.path, self.dropped))
+
+    def open(self):
+        return gzip.open(self.path, 'ab')
+
+    def rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self.path, index)):
+                os.replace('{}.{}'.format(self.path, index), '{}.{}'.format(self.path, index + 1))
+        if self.backups:
+            os.replace(self.path, '{}.1'.format(self.path))
+        else:
+            os.remove(self.path)
+
+    def run(self):
+        capture = None
+        next_flush = time.time() + self.flush_interval
+        try:
+            capture = self.open()
+            while True:
+                try:
+                    item = self.queue.get(timeout=max(next_flush - time.time(), 0))
+                except queue.Empty:
+                    item = False
+                if item is None:
+                    break
+                if item:
+                    ts, source, payload = item
+                    capture.write(CAPTURE_RECORD.pack(ts, CAPTURE_SOURCES.index(source), len(payload)))
+                    capture.write(payload)
+                    self.recorded += 1
+                if time.time() >= next_flush:
+                    next_flush = time.time() + self.flush_interval
+                    capture.flush()
+                    if os.path.getsize(self.path) > self.max_bytes:
+                        capture.close()
+                        capture = None
+                        self.rotate()
+                        capture = self.open()
+        except (IOError, OSError) as err:
+            logerr('Unable to record to {}: {}'.format(self.path, err))
+        finally:
+            if capture is not None:
+                capture.close()
+
+
+def read_capture(path):
+    """Stream the (ts, source, payload) records of a capture back."""
+    with gzip.open(path, 'rb') as capture:
+        while True:
+            try:
+                header = capture.read(CAPTURE_RECORD.size)
+                if len(header) < CAPTURE_RECORD.size:
+                    break
+                ts, source, length = CAPTURE_RECORD.unpack(header)
+                payload = capture.read(length)
+            except EOFError:
+                # The writer was stopped in the middle of a record
+                break
+            if len(payload) < length:
+                break
+            yield ts, CAPTURE_SOURCES[source], payload
+
+
+def read_capture_data(path):
+    """Stream the (ts, source, WLL data record) of a capture or of a JSON-lines
+    session file (see WllEmulator) back. real_time responses are skipped."""
+    with open(path, 'rb') as capture:
+        recorded = capture.read(2) == b'\x1f\x8b'
+
+    if recorded:
+        for ts, source, payload in read_capture(path):
+            if source == 'real_time':
+                continue
+            try:
+                data = parse_json(payload)
+            except ValueError:
+                continue
+            if source == 'http':
+                data = data.get('data')
+            if data:
+                yield ts, source, data
+    else:
+        with open(path, 'rb') as capture:
+            for line in capture:
+                if line.strip():
+                    record = parse_json(line)
+                    yield record['ts'], record['source'], record['data']
+
+
+def replay_capture(station, path):
+    """Decode a capture offline through station, yielding the LOOP packets.
+
+    The station is set up from the first current_conditions response in the
+    capture; UDP packets before it are skipped.
+    """
+    ready = False
+    for ts, source, data in read_capture_data(path):
+        if source == 'http' and not ready:
+            station.set_up_station(data)
+            ready = True
+        if ready and data.get('conditions'):
+            yield station.decode_data_wll(data, udp=source == 'udp')
+
+
+def backfill(config_path, paths, binding='wx_binding', interval=None, batch_size=1000):
+    """Decode captures offline into archive records of a WeeWX database.
+
+    The captures (see read_capture_data()) are streamed through the decoder and
+    rain accounting of the driver, in order, and accumulated into archive
+    records of interval seconds (archive_interval of [StdArchive] by default).
+    The records are inserted batch_size at a time, so memory use does not grow
+    with the size of the captures. Records that are already in the database
+    are skipped. Returns (packets, records inserted).
+    """
+    import weecfg
+    import weewx.accum
+    import weewx.manager
+
+    config_path, config_dict = weecfg.read_config(config_path)
+    if hasattr(weewx.accum, 'initialize'):
+        weewx.accum.initialize(config_dict)
+    if interval is None:
+        interval = int(config_dict.get('StdArchive', {}).get('archive_interval', 300))
+
+    # Decode with the same options as the driver
+    driver_dict = config_dict.get('WeatherLinkLiveUDP', {})
+    station = WllStation(None)
+    station.set_extra1(driver_dict.get('extra_id'))
+    station.set_sensor_map(driver_dict.get('sensor_map'))
+
+    packets = 0
+    late = 0
+    inserted = 0
+    batch = []
+    accumulator = None
+
+    def close(accumulator):
+        record = accumulator.getRecord()
+        record['interval'] = interval // 60
+        batch.append(record)
+
+    start = time.time()
+    with weewx.manager.open_manager_with_config(config_dict, binding, initialize=True) as manager:
+
+        def flush():
+            # addRecord() inserts a list of records in transactions
+            added = manager.addRecord(batch, log_success=False, log_failure=False)
+            del batch[:]
+            return added
+
+        for path in paths:
+            loginf('Backfilling {} into {}'.format(path, binding))
+            for ts, source, data in read_capture_data(path):
+                if source == 'http' and station.rainbarrel.rain_previous_period is None:
+                    station.set_up_station(data)
+                if station.rainbarrel.rain_previous_period is None or not data.get('conditions'):
+                    # UDP before the first current_conditions response
+                    continue
+                packet = station.decode_data_wll(data, udp=source == 'udp')
+                packets += 1
+
+                if accumulator is not None and not accumulator.timespan.includesArchiveTime(packet['dateTime']):
+                    if packet['dateTime'] <= accumulator.timespan.start:
+                        # Only the rain of a late packet is kept, in the current interval
+                        late += 1
+                        if packet.get('rain'):
+                            accumulator.addRecord({'dateTime': accumulator.timespan.stop,
+                                                   'usUnits': packet['usUnits'], 'rain': packet['rain']})
+                        continue
+                    close(accumulator)
+                    accumulator = None
+                    if len(batch) >= batch_size:
+                        inserted += flush() or 0
+                if accumulator is None:
+                    interval_start = weeutil.weeutil.startOfInterval(packet['dateTime'], interval)
+                    accumulator = weewx.accum.Accum(weeutil.weeutil.TimeSpan(interval_start, interval_start + interval),
+                                                    unit_system=packet['usUnits'])
+                accumulator.addRecord(packet)
+
+        if accumulator is not None:
+            close(accumulator)
+        if batch:
+            inserted += flush() or 0
+
+    elapsed = time.time() - start
+    loginf('Backfilled {} packets into {} records in {:.1f} s ({:.0f} packets/s, {:.0f} records/s), {} late packets'
+           .format(packets, inserted, elapsed, packets / max(elapsed, 1e-9), inserted / max(elapsed, 1e-9), late))
+    return packets, inserted
+
+
+class FileSink:
+    """Appends packets, one JSON object per line, to a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+
+    def send(self, batch):
+        for station, payload in batch:
+            self.file.write(payload)
+            self.file.write(b'\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class UdpSink:
+    """Sends every packet as a JSON datagram, e.g. to a multicast group."""
+
+    def __init__(self, address, port, ttl=1):
+        self.target = (address, port)
+        self.socket = socket.socket(AF_INET, SOCK_DGRAM)
+        self.socket.setsockopt(IPPROTO_IP, IP_MULTICAST_TTL, ttl)
+
+    def send(self, batch):
+        for station, payload in batch:
+            self.socket.sendto(payload, self.target)
+
+    def close(self):
+        self.socket.close()
+
+
+class MqttSink:
+    """Publishes packets to topic (topic/<station> for the other stations) of
+    an MQTT broker. Needs paho-mqtt."""
+
+    def __init__(self, host, port=1883, topic='weatherlinklive', username=None, password=None, qos=0):
+        if mqtt is None:
+            raise ImportError('paho-mqtt is not installed')
+        self.topic = topic
+        self.qos = qos
+        if hasattr(mqtt, 'CallbackAPIVersion'):
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        else:
+            self.client = mqtt.Client()
+        if username:
+            self.client.username_pw_set(username, password)
+        # paho reconnects and sends from its own network thread
+        self.client.connect_async(host, port)
+        self.client.loop_start()
+
+    def send(self, batch):
+        failed = 0
+        for station, payload in batch:
+            info = self.client.publish('{}/{}'.format(self.topic, station) if station else self.topic, payload, self.qos)
+            # Without a connection paho keeps a message of qos 1 or 2 for the
+            # reconnect, one of qos 0 is lost
+            if info.rc != mqtt.MQTT_ERR_SUCCESS and not (self.qos and info.rc == mqtt.MQTT_ERR_NO_CONN):
+                failed += 1
+                error = mqtt.error_string(info.rc)
+        if failed:
+            raise IOError('{} of {} packets not published: {}'.format(failed, len(batch), error))
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class PacketPublisher:
+    """Hands LOOP packets to output sinks on a background thread.
+
+    publish() never blocks the driver loop: packets are queued, and when the
+    queue is full the packet is dropped and counted. The thread encodes the
+    packets to JSON once and sends up to batch_size of them to every sink in
+    one go. A failing sink is counted and logged, it does not stop the others.
+    """
 
-            # maximum wind speed over last 2 min **(mph)**
-            packet['windGust'] = iss_data['wind_speed_hi_last_2_min']
+    def __init__(self, sinks, queue_size=1000, batch_size=50):
+        self.sinks = sinks
+        self.batch_size = batch_size
+
+        self.queue = queue.Queue(queue_size)
+        self.published = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self.thread = threading.Thread(target=self.run, name='WLL publisher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, packet, station=''):
+        try:
+            self.queue.put_nowait((station, packet))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=5)
+            except queue.Full:
+                logerr('Publisher does not keep up, stopping it')
+            self.thread.join(10)
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as err:
+                logerr('Unable to close {}: {}'.format(type(sink).__name__, err))
+        logdbg('Published {} packets, dropped {}, {} sink errors'.format(self.published, self.dropped, self.errors))
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            items = [self.queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in items:
+                stopping = True
+                items = items[:items.index(None)]
+
+            batch = [(station, json.dumps(packet, separators=(',', ':')).encode('utf-8'))
+                     for station, packet in items]
+            for sink in self.sinks:
+                try:
+                    sink.send(batch)
+                except Exception as err:
+                    self.errors += 1
+                    logerr('Unable to publish to {}: {}'.format(type(sink).__name__, err))
+            self.published += len(batch)
+
+
+def open_sinks(stn_dict):
+    """The output sinks configured in the driver stanza."""
+    sinks = []
+    if stn_dict.get('publish_file'):
+        sinks.append(FileSink(stn_dict['publish_file']))
+    if stn_dict.get('publish_udp'):
+        address, _, port = stn_dict['publish_udp'].rpartition(':')
+        sinks.append(UdpSink(address, int(port), ttl=int(stn_dict.get('publish_udp_ttl', 1))))
+    if stn_dict.get('publish_mqtt'):
+        host, _, port = stn_dict['publish_mqtt'].partition(':')
+        try:
+            sinks.append(MqttSink(host, int(port or 1883),
+                                  topic=stn_dict.get('publish_mqtt_topic', 'weatherlinklive'),
+                                  username=stn_dict.get('publish_mqtt_username'),
+                                  password=stn_dict.get('publish_mqtt_password'),
+                                  qos=int(stn_dict.get('publish_mqtt_qos', 0))))
+        except ImportError as err:
+            logerr('Unable to publish to MQTT: {}'.format(err))
+    return sinks
+
+
+def find_iss_condition(conditions, txid=None):
+    """The condition record of the main ISS in conditions: the ISS of txid,
+    else the first ISS with a rain collector, else the first ISS."""
+    iss = [condition for condition in conditions
+           if condition.get('data_structure_type') == ISS_CURRENT_CONDITIONS]
+    for condition in iss:
+        if txid is not None and condition.get('txid') == txid:
+            return condition
+    for condition in iss:
+        if 1 <= (condition.get('rain_size') or 0) <= 4:
+            return condition
+    return iss[0] if iss else conditions[0]
+
+
+class StationProfile:
+    """What a WLL reports: its device id and address, the tx id and rain
+    collector of the main ISS, and the record types of every transmitter.
+
+    It is probed from a current_conditions response and cached on disk, so a
+    restart can set up the decoder without waiting for the WLL.
+    """
 
-            # gust wind direction over last 2 min **(degree)**
-            packet['windGustDir'] = iss_data["wind_dir_at_hi_speed_last_2_min"]
+    def __init__(self, did=None, address=None, port=80, txid_iss=None, rain_size=None, conditions=()):
+        self.did = did
+        self.address = address
+        self.port = port
+        self.txid_iss = txid_iss
+        self.rain_size = rain_size
+        # [{'txid': .., 'data_structure_type': ..}], the layout of the condition records
+        self.conditions = list(conditions)
+
+    @classmethod
+    def from_data(cls, data, address=None, port=80):
+        conditions = data.get('conditions') or []
+        iss = find_iss_condition(conditions) if conditions else dict()
+        return cls(did=data.get('did'), address=address, port=port,
+                   txid_iss=iss.get('txid'), rain_size=iss.get('rain_size'),
+                   conditions=[{'txid': condition.get('txid'),
+                                'data_structure_type': condition.get('data_structure_type')}
+                               for condition in conditions])
+
+    def as_dict(self):
+        return {'did': self.did, 'address': self.address, 'port': self.port, 'txid_iss': self.txid_iss,
+                'rain_size': self.rain_size, 'conditions': self.conditions}
+
+    def save(self, path):
+        save_json(path, self.as_dict())
+
+    @classmethod
+    def load(cls, path):
+        """The profile cached in path, or None."""
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path) as profile_file:
+                return cls(**json.load(profile_file))
+        except (IOError, OSError, ValueError, TypeError) as err:
+            logerr('Unable to load the station profile from {}: {}'.format(path, err))
+            return None
+
+    def apply(self, station):
+        """Set up station from the profile, without rain state."""
+        station.set_txid(self.txid_iss)
+        if self.rain_size:
+            station.rainbarrel.set_up_bucket_size({'rain_size': self.rain_size})
+        station.build_decoder(self.conditions)
+
+    def describe(self):
+        transmitters = ', '.join('{}/{}'.format(condition['txid'], condition['data_structure_type'])
+                                 for condition in self.conditions)
+        return '{} at {}:{}, ISS tx id {}, rain collector {}, tx id/record type {}'.format(
+            self.did, self.address, self.port, self.txid_iss, self.rain_size, transmitters)
+
+
+MDNS_ADDRESS = ('224.0.0.251', 5353)
+MDNS_SERVICE = '_weatherlinklive._tcp.local'
+DNS_A = 1
+DNS_PTR = 12
+DNS_SRV = 33
+
+
+def encode_dns_name(name):
+    return b''.join(bytes([len(label)]) + label.encode('utf-8') for label in name.split('.')) + b'\0'
+
+
+def read_dns_name(message, offset):
+    """The name at offset of a DNS message, and the offset after it."""
+    labels = []
+    end = None
+    for _ in range(128):
+        length = message[offset]
+        if length & 0xc0 == 0xc0:
+            # Compressed: the rest of the name is elsewhere in the message
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3f) << 8) | message[offset + 1]
+            continue
+        offset += 1
+        if not length:
+            break
+        labels.append(message[offset:offset + length].decode('utf-8', 'replace'))
+        offset += length
+    return '.'.join(labels), offset if end is None else end
+
+
+def read_dns_records(message):
+    """The (name, type, value) resource records of a DNS message. The value
+    is the name of a PTR, the (target, port) of an SRV or the address of an A record."""
+    records = []
+    _, _, questions, answers, authorities, additionals = struct.unpack('!6H', message[:12])
+    offset = 12
+    for _ in range(questions):
+        _, offset = read_dns_name(message, offset)
+        offset += 4
+    for _ in range(answers + authorities + additionals):
+        name, offset = read_dns_name(message, offset)
+        record_type, _, _, length = struct.unpack('!HHIH', message[offset:offset + 10])
+        offset += 10
+        if record_type == DNS_PTR:
+            records.append((name.lower(), record_type, read_dns_name(message, offset)[0].lower()))
+        elif record_type == DNS_SRV:
+            port = struct.unpack('!H', message[offset + 4:offset + 6])[0]
+            records.append((name.lower(), record_type, (read_dns_name(message, offset + 6)[0].lower(), port)))
+        elif record_type == DNS_A and length == 4:
+            records.append((name.lower(), record_type, socket.inet_ntoa(message[offset:offset + 4])))
+        offset += length
+    return records
+
+
+def discover(timeout=5, udp_port=22222, mdns_address=MDNS_ADDRESS):
+    """Find the WLLs on the LAN, from their answers to an mDNS query for
+    _weatherlinklive._tcp and from real_time UDP broadcasts that are already
+    running. Returns a list of {'address', 'port', 'name'}."""
+    found = dict()
+    selector = selectors.DefaultSelector()
+
+    mdns_socket = socket.socket(AF_INET, SOCK_DGRAM)
+    mdns_socket.setsockopt(IPPROTO_IP, IP_MULTICAST_TTL, 1)
+    # A query from another port than 5353 is answered by unicast, to this socket
+    try:
+        mdns_socket.sendto(struct.pack('!6H', 0, 0, 1, 0, 0, 0) + encode_dns_name(MDNS_SERVICE)
+                           + struct.pack('!HH', DNS_PTR, 1), mdns_address)
+    except OSError as err:
+        logerr('Unable to send the mDNS query to {}: {}'.format(mdns_address[0], err))
+    selector.register(mdns_socket, selectors.EVENT_READ, 'mdns')
+
+    udp_socket = None
+    if udp_port:
+        try:
+            udp_socket = socket.socket(AF_INET, SOCK_DGRAM)
+            udp_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            udp_socket.bind(('', udp_port))
+            selector.register(udp_socket, selectors.EVENT_READ, 'udp')
+        except OSError as err:
+            logdbg('Not listening for broadcasts on port {}: {}'.format(udp_port, err))
+            if udp_socket is not None:
+                udp_socket.close()
+            udp_socket = None
+
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            for key, _ in selector.select(max(deadline - time.monotonic(), 0)):
+                try:
+                    message, (address, _) = key.fileobj.recvfrom(4096)
+                except OSError:
+                    # e.g. the ICMP port unreachable of a query to a host without mDNS
+                    continue
+                if key.data == 'udp':
+                    try:
+                        name = parse_json(message).get('did')
+                    except (ValueError, AttributeError):
+                        continue
+                    found.setdefault(address, {'address': address, 'port': 80, 'name': name})
+                    continue
+                try:
+                    records = read_dns_records(message)
+                except (IndexError, struct.error):
+                    continue
+                instances = [value for name, record_type, value in records
+                             if record_type == DNS_PTR and name == MDNS_SERVICE]
+                services = dict((name, value) for name, record_type, value in records if record_type == DNS_SRV)
+                hosts = dict((name, value) for name, record_type, value in records if record_type == DNS_A)
+                for instance in instances:
+                    target, port = services.get(instance, (None, 80))
+                    host = hosts.get(target, address)
+                    found[host] = {'address': host, 'port': port, 'name': instance.split('.')[0]}
+    finally:
+        selector.close()
+        mdns_socket.close()
+        if udp_socket is not None:
+            udp_socket.close()
+    return sorted(found.values(), key=lambda device: device['address'])
+
+
+def probe(http, address, port=80):
+    """The StationProfile of the WLL at address, or None when it does not answer."""
+    response = http.request('http://{}:{}/v1/current_conditions'.format(address, port))
+    if response is None or not response.get('data'):
+        return None
+    return StationProfile.from_data(response['data'], address, port)
 
-            # wind speed and direction average for the last 10 minutes
-            # (not recorded in archive but used elsewhere)
-            packet['windSpeed10'] = iss_data["wind_speed_avg_last_10_min"]
-            packet['windDir10'] = iss_data["wind_dir_scalar_avg_last_10_min"]
-            
-            # most recent valid temperature **(F)**
-            packet['outTemp'] = iss_data['temp']
 
-            # most recent valid humidity **(%RH)**
-            packet['outHumidity'] = iss_data['hum']
+class WllStation:
+    def __init__(self, http, stats=None):
+        self.http = http
+        self.stats = stats if stats is not None else DriverStats()
+        self.poll_interval = 10
+        self.txid_iss = None
+        self.extra1 = None
+        self.sensor_map = dict()
 
-            # **(F)**
-            packet['dewpoint'] = iss_data['dew_point']
+        self.real_rime_url = None
+        self.current_conditions_url = None
+        # Seconds the UDP broadcast is requested for at a time
+        self.broadcast_duration = 3600
+
+
+        self.decoder = dict()
+
+        self.rainbarrel = RainBarrel()
+
+        # Set by the driver, see WeatherLinkLiveUDPDriver.add_station()
+        self.name = ''
+        self.field_prefix = ''
+        self.address = None
+        self.port = 80
+        # Cached StationProfile, see update_profile()
+        self.profile = None
+        self.profile_file = None
+        # Arguments of discover() for a station with wll_ip = auto, and the
+        # address a broadcast of its WLL last came from when that is not
+        # address, see WeatherLinkLiveUDPDriver.source_station()
+        self.discovery = None
+        self.moved_to = None
+        self.coalescer = None
+        # PollScheduler of the HTTP polls and BroadcastLease of the UDP broadcast
+        self.scheduler = None
+        self.lease = None
+        # Optional WindSampler for gusts at UDP cadence and QualityFilter
+        self.wind = None
+        self.quality = None
+        self.last_udp = 0
+        # Monotonic time the last datagram arrived
+        self.last_datagram = 0
+        self.udp_datagrams = 0
+        # dateTime of the last packet yielded, and the observations of
+        # out of order packets that go with the next one, see finish_packet()
+        self.last_yielded = None
+        self.held = dict()
+
+        # Restored state still has to be checked against the WLL, see reconcile()
+        self.reconcile_pending = False
+
+    def set_address(self, host, port=80):
+        """Point the station at the WLL at host:port."""
+        try:
+            self.address = socket.gethostbyname(host)
+        except socket.error:
+            self.address = host
+        self.port = port
+        # Tells the WW to begin broadcasting UDP data and continue for broadcast_duration seconds
+        self.real_rime_url = 'http://{}:{}/v1/real_time?duration={}'.format(host, port, self.broadcast_duration)
+        self.current_conditions_url = 'http://{}:{}/v1/current_conditions'.format(host, port)
+        if self.lease is not None:
+            self.lease.move(self.real_rime_url)
 
-            # **(F)**
-            packet['heatindex'] = iss_data['heat_index']
+    def set_poll_interval(self, data):
+        self.poll_interval = data
+        if self.poll_interval < 10:
+            logerr('Unable to set Poll Interval (minimal 10 s.)')
+        loginf('HTTP polling interval is %s' % self.poll_interval)
 
-            # **(F)**
-            packet['windchill'] = iss_data['wind_chill']
-            
-            # **(F)**
-            packet['THSW'] = iss_data['thsw_index']
-            
-            packet['outWetbulb'] = iss_data['wet_bulb']
+    def set_txid(self, data):
+        if data:
+            self.txid_iss = int(data)
+            self.rainbarrel.txid = self.txid_iss
+            loginf('tx id of ISS is {}'.format(self.txid_iss))
 
-            # most recent solar radiation **(W/m)**
-            packet['radiation'] = iss_data['solar_rad']
+    def set_extra1(self, data):
+        if data:
+            self.extra1 = int(data)
+            loginf('Extra sensor is using id: {}'.format(self.extra1))
 
-            # most recent UV index **(Index)**
-            packet['UV'] = iss_data['uv_index']
+    def set_up_station(self, data):
+        """Set up the ISS, rain and decoder from a current_conditions data record."""
+        main_condition = find_iss_condition(data['conditions'])
+        self.set_txid(main_condition['txid'])
+
+        # Set Bucket Size
+        self.rainbarrel.set_up_bucket_size(main_condition)
+
+        # Check current rain for the day and set it
+        self.rainbarrel.set_rain_previous_period(main_condition['rainfall_daily'])
+
+        # Set date for previous rain
+        self.rainbarrel.set_rain_previous_date(data['ts'])
+
+        self.build_decoder(data['conditions'])
+        self.update_profile(data)
+
+    def reconcile(self, data):
+        """Check state restored at startup against the first current_conditions data record."""
+        self.reconcile_pending = False
+        conditions = data['conditions']
+        main_condition = find_iss_condition(conditions, self.txid_iss)
+
+        if main_condition.get('txid') != self.txid_iss:
+            self.set_txid(main_condition.get('txid'))
+        self.rainbarrel.set_up_bucket_size(main_condition)
+
+        # The daily counter went back on the same day: the WLL was reset, so
+        # count from its current value rather than emit negative rain
+        rainfall_daily = main_condition.get('rainfall_daily')
+        if (rainfall_daily is not None and self.rainbarrel.rain_previous_period is not None
+                and (self.rainbarrel.last_ts is None or data['ts'] > self.rainbarrel.last_ts
+                     or data['ts'] < self.rainbarrel.last_ts - self.poll_interval)
+                and data['ts'] < self.rainbarrel.previous_date_stamp
+                and rainfall_daily < self.rainbarrel.rain_previous_period):
+            logerr('Daily rain of the WLL ({}) is below the restored state ({}), restarting from it'
+                   .format(rainfall_daily, self.rainbarrel.rain_previous_period))
+            self.rainbarrel.set_rain_previous_period(rainfall_daily)
+
+        self.build_decoder(conditions)
+        self.update_profile(data)
+        loginf('Restored state reconciled with the WLL')
+
+    def update_profile(self, data):
+        """Refresh the StationProfile from a current_conditions data record, and
+        cache it when it changed."""
+        profile = StationProfile.from_data(data, self.address, self.port)
+        if self.profile_file and (self.profile is None or profile.as_dict() != self.profile.as_dict()):
+            try:
+                profile.save(self.profile_file)
+                loginf('Station profile saved to {}'.format(self.profile_file))
+            except (IOError, OSError) as err:
+                logerr('Unable to save the station profile to {}: {}'.format(self.profile_file, err))
+        self.profile = profile
+
+    def set_sensor_map(self, data):
+        """data maps WeeWX fields to '<WLL field>.<txid>', e.g. extraTemp2 = temp.3"""
+        self.sensor_map = dict()
+        for field, source in (data or dict()).items():
+            try:
+                key, txid = source.rsplit('.', 1)
+                self.sensor_map.setdefault(int(txid), []).append((field, key))
+            except ValueError:
+                logerr('Unable to map {} to {}, expected <WLL field>.<txid>'.format(field, source))
+                continue
+            loginf('{} is mapped to {} of tx id {}'.format(field, key, txid))
+
+    def build_decoder(self, conditions=None):
+        """Compile the (data_structure_type, txid) -> DecodeSpec index.
+
+        conditions is the list of condition records of a current_conditions
+        response and tells which record types each transmitter sends. Without
+        it, mapped transmitters are looked for in ISS and Leaf/Soil records.
+        """
+        decoder = dict()
+        decoder[(ISS_CURRENT_CONDITIONS, self.txid_iss)] = DecodeSpec(ISS_HTTP_FIELDS, ISS_UDP_FIELDS, rain=True)
+        decoder[(LSS_BAR_CURRENT_CONDITIONS, None)] = DecodeSpec(LSS_BAR_FIELDS)
+        decoder[(LSS_TEMP_HUM_CURRENT_CONDITIONS, None)] = DecodeSpec(LSS_TEMP_HUM_FIELDS)
+
+        sensor_map = dict((txid, list(fields)) for txid, fields in self.sensor_map.items())
+        if self.extra1:
+            sensor_map.setdefault(self.extra1, []).extend(EXTRA_FIELDS)
+
+        layout = dict()
+        for condition in conditions or ():
+            if condition.get('txid') is not None:
+                layout.setdefault(condition['txid'], set()).add(condition.get('data_structure_type'))
+
+        # The first Leaf/Soil transmitter without a mapping gets the default fields
+        leaf_soil = sorted(txid for txid, structure_types in layout.items()
+                           if LEAF_SOIL_CURRENT_CONDITIONS in structure_types and txid not in sensor_map)
+        if leaf_soil:
+            sensor_map[leaf_soil[0]] = list(LEAF_SOIL_FIELDS)
+            loginf('Leaf/Soil station is using id: {}'.format(leaf_soil[0]))
+            for txid in leaf_soil[1:]:
+                loginf('Leaf/Soil station with id {} is not mapped, add it to [[sensor_map]]'.format(txid))
+
+        for txid, fields in sensor_map.items():
+            for structure_type in layout.get(txid, (ISS_CURRENT_CONDITIONS, LEAF_SOIL_CURRENT_CONDITIONS)):
+                spec = decoder.get((structure_type, txid))
+                if spec is None:
+                    decoder[(structure_type, txid)] = DecodeSpec(optional_fields=fields)
+                else:
+                    decoder[(structure_type, txid)] = spec.extend(fields)
+
+        self.decoder = decoder
+
+    def decode_data_wll(self, data, udp=False):
+        timestamp = data['ts']
+        packet = {'dateTime': timestamp, 'usUnits': weewx.US}
 
-            # transmitter battery status flag **(no unit)**
-            packet['txBatteryStatus'] = iss_data['trans_battery_flag']
+        decoder = self.decoder
+        for condition in data['conditions']:
+            spec = decoder.get((condition.get('data_structure_type'), condition.get('txid')))
+            if spec is None:
+                continue
 
-            # configured radio receiver state **(no unit)**
-            packet['signal1'] = iss_data['rx_state']
+            spec.extract(condition, packet, udp)
 
-            self.rainbarrel.rain = iss_data['rainfall_daily']
-            packet['rainRate'] = iss_data['rain_rate_last'] * self.rainbarrel.bucketsize
+            if spec.rain:
+                # Rain
+                if condition.get('rainfall_daily') is None:
+                    logdbg("Error: {}->rainfall_daily not defined".format('UDP' if udp else 'HTTP'))
+                    self.stats.count('values_rejected')
+                    continue
+                self.rainbarrel.rain = condition['rainfall_daily']
 
-            self.calculate_rain()
+                if condition.get('rain_rate_last') is None:
+                    logdbg("Error: {}->rain_rate_last not defined".format('UDP' if udp else 'HTTP'))
+                else:
+                    packet['rainRate'] = condition['rain_rate_last'] * self.rainbarrel.bucketsize
 
-            packet['rain'] = self.davis_packet['rain']
-            if packet['rain'] > 0:
-                logdbg('HTTP rain detect: {} buckets -> {} in'
-                       .format(packet['rain'] / self.rainbarrel.bucketsize,
-                               packet['rain']))
+                start = time.perf_counter()
+                rain = self.calculate_rain(timestamp)
+                self.stats.calculate_rain.add(time.perf_counter() - start)
+                packet['rain'] = rain
 
-        if lss_bar_data:
-            # most recent bar sensor reading with elevation adjustment **(inches)**
-            packet['altimeter'] = lss_bar_data['bar_sea_level']
-            packet['pressure'] = lss_bar_data['bar_absolute']
+                if rain > 0:
+                    logdbg('{} rain detect: {} buckets -> {} in'
+                           .format('UDP' if udp else 'HTTP', rain / self.rainbarrel.bucketsize, rain))
 
-        if lss_temp_hum_data:
-            # most recent valid inside temp **(F)**
-            packet['inTemp'] = lss_temp_hum_data['temp_in']
-            # most recent valid inside humidity **(%RH)**
-            packet['inHumidity'] = lss_temp_hum_data['hum_in']
-            # **(F)**
-            packet['inDewpoint'] = lss_temp_hum_data['dew_point_in']
+        if self.quality is not None:
+            self.quality.check(timestamp, packet)
 
-        if extra_data1:
-            if extra_data1.get('temp'):
-                packet['extraTemp1'] = extra_data1['temp']
-            if extra_data1.get('hum'):
-                packet['extraHumid1'] = extra_data1['hum']
+        if udp and self.wind is not None and 'windSpeed' in packet:
+            self.wind.update_packet(timestamp, packet)
 
         return packet
 
-    def calculate_rain(self):
-        if self.davis_date_stamp.timestamp() > self.rainbarrel.previous_date_stamp.timestamp():
+    def calculate_rain(self, ts):
+        """Rain (in) since the previous data record, ts is the time of this record."""
+        previous_ts = self.rainbarrel.last_ts
+        if previous_ts is not None and ts < previous_ts:
+            if ts >= previous_ts - self.poll_interval:
+                # An HTTP response handled after a newer UDP datagram: its counter
+                # is stale, and the newer records already counted its rain
+                logdbg('Skipping the rain of a record of {}, older than {}'.format(ts, previous_ts))
+                self.stats.count('rain_records_stale')
+                return 0.0
+            # Further back the clock of the WLL (or of the saved state) was off:
+            # count from here
+            loginf('Time of the WLL went back from {} to {}'.format(previous_ts, ts))
+        self.rainbarrel.last_ts = ts
+
+        if self.rainbarrel.previous_date_stamp is None or self.rainbarrel.rain_previous_period is None:
+            # Nothing known about today yet: start counting from here
+            logdbg('Rain state is not set up, starting at {} buckets'.format(self.rainbarrel.rain))
+            self.rainbarrel.previous_date_stamp = None
+            self.rainbarrel.rain_previous_period = self.rainbarrel.rain
+            self.rainbarrel.set_rain_previous_date(ts)
+
+        # A record of 00:00:00 already has the counter of the new day
+        if ts >= self.rainbarrel.previous_date_stamp:
 
             # Reset Previous rain at Midnight
-            logdbg('Previous: {}'.format(self.rainbarrel.previous_date_stamp))
-            logdbg('Davis:   {}'.format(self.davis_date_stamp))
-            logdbg('System:   {}'.format(self.system_date_stamp))
+            logdbg('Previous: {}'.format(weeutil.weeutil.timestamp_to_string(self.rainbarrel.previous_date_stamp)))
+            logdbg('Davis:   {}'.format(weeutil.weeutil.timestamp_to_string(ts)))
+            logdbg('System:   {}'.format(weeutil.weeutil.timestamp_to_string(time.time())))
             logdbg('daily rain Davis:     {}'.format(self.rainbarrel.rain))
             logdbg('prev. before reset:   {}'.format(self.rainbarrel.rain_previous_period))
 
-            self.rainbarrel.set_rain_previous_date(self.davis_date_stamp)
+            self.rainbarrel.set_rain_previous_date(ts)
             self.rainbarrel.set_rain_previous_period(0)
 
             logdbg('prev after reset:     {}'.format(self.rainbarrel.rain_previous_period))
             logdbg('({}) Daily rain reset - next reset midnight {}'
-                   .format(weeutil.weeutil.timestamp_to_string(time.time()), str(self.rainbarrel.previous_date_stamp)))
+                   .format(weeutil.weeutil.timestamp_to_string(time.time()),
+                           weeutil.weeutil.timestamp_to_string(self.rainbarrel.previous_date_stamp)))
 
         if self.rainbarrel.rain < self.rainbarrel.rain_previous_period:
-            logdbg('({}) Negative Rain'.format(weeutil.weeutil.timestamp_to_string(time.time())))
+            if ts == previous_ts:
+                # As old as the record counted last, so not after a reset
+                return 0.0
+            # The counter went back without a midnight: the WLL was reset, so
+            # count from its current value rather than emit negative rain
+            logdbg('({}) Negative Rain, daily rain of the WLL went from {} to {} buckets'
+                   .format(weeutil.weeutil.timestamp_to_string(time.time()),
+                           self.rainbarrel.rain_previous_period, self.rainbarrel.rain))
+            self.stats.count('rain_counter_resets')
+            self.rainbarrel.rain_previous_period = self.rainbarrel.rain
+            self.rainbarrel.dirty = True
 
         rain_now = self.rainbarrel.rain - self.rainbarrel.rain_previous_period
         if rain_now > 0:
@@ -364,6 +1783,7 @@ class WllStation:
                            self.rainbarrel.rain_previous_period))
 
             self.rainbarrel.rain_previous_period = self.rainbarrel.rain
+            self.rainbarrel.dirty = True
             # Empty Barrel
             self.rainbarrel.empty_rain_barrel()
 
@@ -377,148 +1797,1230 @@ class WllStation:
                            round(self.rainbarrel.rain_previous_period * self.rainbarrel.bucketsize * 25.4, 1),
                            round(self.rainbarrel.rain_previous_period * self.rainbarrel.bucketsize, 2)))
 
-        self.davis_packet['rain'] = rain_now * self.rainbarrel.bucketsize
+        return rain_now * self.rainbarrel.bucketsize
 
-    def check_udp_broascast(self):
-        if (self.udp_countdown - 360) < time.time():
-            response = make_request_using_socket(self.real_rime_url)
-            if response is None:
-                logerr('Unable to connect to Weather Link Live')
-            elif response.get('data'):
-                Req_data = response
-                self.udp_countdown = time.time() + Req_data['data']['duration']
-                logdbg('UDP check at: {}'.format(weeutil.weeutil.timestamp_to_string(self.udp_countdown)))
 
+class BroadcastLease:
+    """Keeps the real_time UDP broadcast of a WLL on.
 
-class WeatherLinkLiveUDPDriver(weewx.drivers.AbstractDevice):
-    """weewx driver that reads data from a WeatherLink Live
+    The broadcast is requested for a duration (in the url) and renewed once,
+    margin seconds before it expires. When no datagram arrived for
+    loss_timeout seconds the broadcast is taken as lost and requested again.
+    Failed requests, and requests after which the broadcast stays lost, are
+    retried with exponential backoff from loss_timeout up to backoff_max
+    seconds. All times are on the monotonic clock.
     """
 
-    def __init__(self, **stn_dict):
-        # Show Diver version
-        loginf('WLL UDP driver version is %s' % DRIVER_VERSION)
+    def __init__(self, http, url, margin=360, loss_timeout=10, backoff_max=300, stats=None):
+        self.http = http
+        self.url = url
+        self.margin = margin
+        self.loss_timeout = loss_timeout
+        self.backoff_max = backoff_max
+        self.stats = stats if stats is not None else DriverStats()
+
+        self.expires = 0.0
+        # Time of the last request, and no request before retry
+        self.renewed = float('-inf')
+        self.retry = 0.0
+        self.failures = 0
+
+    def move(self, url):
+        """Request the broadcast from url from now on, right away."""
+        self.url = url
+        self.expires = 0.0
+        self.renewed = float('-inf')
+        self.retry = 0.0
+        self.failures = 0
+
+    def deadline(self, last_datagram):
+        """Time of the next renewal, if nothing arrives until then."""
+        due = min(self.expires - self.margin, max(last_datagram, self.renewed) + self.loss_timeout)
+        return max(due, self.retry)
+
+    def check(self, last_datagram, now=None):
+        """Renew the lease when it is about to expire or the broadcast is lost.
+        Returns True when it was renewed."""
+        now = time.monotonic() if now is None else now
+        if last_datagram > self.renewed:
+            # The broadcast is on
+            self.failures = 0
+            self.retry = 0.0
+        if now < self.retry:
+            return False
+        lost = False
+        if now < self.expires - self.margin:
+            if now - max(last_datagram, self.renewed) < self.loss_timeout:
+                return False
+            logerr('No UDP broadcast for {:.0f} s, requesting it again'.format(now - last_datagram))
+            lost = True
+
+        renewed = self.renew(now)
+        if lost or not renewed:
+            self.failures += 1
+            self.retry = now + min(self.loss_timeout * 2 ** (self.failures - 1), self.backoff_max)
+            logdbg('Next UDP broadcast request in {:.0f} s at the earliest'.format(self.retry - now))
+        return renewed
+
+    def renew(self, now=None):
+        """Request the broadcast. Returns True when the WLL accepted it."""
+        now = time.monotonic() if now is None else now
+        self.stats.count('broadcast_renewals')
+        start = time.perf_counter()
+        response = self.http.request(self.url, record_as='real_time')
+        self.stats.broadcast_renewal.add(time.perf_counter() - start)
+        self.renewed = now
+
+        if response is None or not response.get('data'):
+            logerr('Unable to connect to Weather Link Live')
+            self.stats.count('broadcast_renewal_failures')
+            return False
+        self.expires = now + response['data']['duration']
+        logdbg('UDP broadcast renewed for {} s'.format(response['data']['duration']))
+        return True
 
-        self.station = WllStation()
 
-        self.station.set_poll_interval(float(stn_dict.get('poll_interval', 10)))
+class MidnightWindow:
+    """The daily blackout window at local midnight, kept as epoch timestamps.
 
-        self.wll_ip = stn_dict.get('wll_ip', '192.168.1.47')
+    The window is only recomputed once it has passed, so testing a time is
+    two float comparisons.
+    """
 
-        if self.wll_ip is None:
-            logerr("No Weatherlink Live IP provided")
+    def __init__(self, duration=5):
+        self.duration = duration
+        self.start = 0.0
+        self.end = 0.0
+        self.update(time.time())
+
+    def update(self, now):
+        day = datetime.date.fromtimestamp(now)
+        start = time.mktime(day.timetuple())
+        if now >= start + self.duration:
+            start = time.mktime((day + datetime.timedelta(days=1)).timetuple())
+        self.start = start
+        self.end = start + self.duration
+
+    def contains(self, now):
+        if now >= self.end:
+            self.update(now)
+        return self.start <= now
+
+
+class PollScheduler:
+    """Schedules the HTTP polls on wall-clock multiples of interval.
+
+    Deadlines are returned on the monotonic clock. Because each deadline is
+    the next boundary rather than the last poll plus interval, the time a
+    request takes does not add to the period, and a poll that overran skips
+    to the next boundary instead of bunching up. Boundaries in the midnight
+    window are moved to its end.
+    """
 
-        self.station.set_extra1(stn_dict.get('extra_id'))
+    def __init__(self, interval, midnight=None):
+        self.interval = interval
+        self.midnight = midnight
+
+    def next_poll(self):
+        wall = time.time()
+        monotonic = time.monotonic()
+        boundary = (math.floor(wall / self.interval) + 1) * self.interval
+        if self.midnight is not None:
+            # Bring the window up to date for now, then test the boundary against it
+            self.midnight.contains(wall)
+            if self.midnight.start <= boundary < self.midnight.end:
+                boundary = self.midnight.end
+        return monotonic + (boundary - wall)
+
+    def observe(self, packet, udp=False, udp_healthy=True):
+        """Adjust the interval to a decoded packet. Returns True when it
+        was shortened, so the pending poll has to be rescheduled."""
+        return False
+
+    def udp_silent(self):
+        """The UDP broadcast timed out. Returns True when the interval was shortened."""
+        return False
+
+
+class AdaptivePollScheduler(PollScheduler):
+    """PollScheduler whose interval follows the weather.
+
+    After an HTTP observation in which temperature, humidity and pressure are
+    stable, and UDP is healthy, the interval is doubled up to ceiling. It drops
+    back to floor as soon as one of them changes quickly, rain is counted or
+    the UDP broadcast goes silent.
+    """
 
-        # Tells the WW to begin broadcasting UDP data and continue for 1 hour seconds
-        self.station.real_rime_url = 'http://{}:80/v1/real_time?duration=3600'.format(self.wll_ip)
-        self.station.current_conditions_url = 'http://{}:80/v1/current_conditions'.format(self.wll_ip)
+    # Change per minute above which a value is changing quickly; below half
+    # of it, the value is stable
+    RATES = (
+        ('outTemp', 0.1),
+        ('outHumidity', 1.0),
+        ('pressure', 0.001),
+    )
+
+    def __init__(self, floor, ceiling, midnight=None):
+        super().__init__(floor, midnight)
+        self.floor = floor
+        self.ceiling = max(ceiling, floor)
+        # (ts, values) of the previous HTTP observation
+        self.previous = None
+
+    def observe(self, packet, udp=False, udp_healthy=True):
+        if packet.get('rain') or packet.get('rainRate'):
+            return self.tighten('rain')
+        if udp:
+            return False
 
-        # Make First Contact with WLL
-        response = make_request_using_socket(self.station.current_conditions_url)
+        ts = packet['dateTime']
+        values = tuple(packet.get(name) for name, _ in self.RATES)
+        previous, self.previous = self.previous, (ts, values)
+        if previous is None or ts <= previous[0]:
+            return False
 
-        if response is None:
-            logerr('Unable to connect to Weather Link Live')
-        elif response.get('data'):
+        minutes = (ts - previous[0]) / 60.0
+        stable = udp_healthy
+        for (name, limit), value, last in zip(self.RATES, values, previous[1]):
+            if value is None or last is None:
+                continue
+            rate = abs(value - last) / minutes
+            if rate > limit:
+                return self.tighten(name)
+            if rate > limit / 2:
+                stable = False
+
+        if stable and self.interval < self.ceiling:
+            self.interval = min(self.interval * 2, self.ceiling)
+            logdbg('HTTP polling interval is {} s'.format(self.interval))
+        return False
+
+    def udp_silent(self):
+        return self.tighten('UDP time out')
+
+    def tighten(self, reason):
+        if self.interval <= self.floor:
+            return False
+        self.interval = self.floor
+        logdbg('HTTP polling interval is {} s ({})'.format(self.interval, reason))
+        return True
+
+
+class HttpPoller:
+    """Polls current_conditions, and keeps the UDP broadcast on, on a thread of
+    its own, so an unreachable WLL never stalls the engine.
+
+    Responses are handed over in a bounded queue of (arrival, response) and
+    wakeup() is called after each one. When the queue is full, stale_policy
+    'replace' discards the oldest queued response and 'drop' the new one.
+
+    After rediscover_after failed polls and broadcast requests in a row,
+    rediscover(station) is called to look for the WLL at another address.
+    """
+
+    def __init__(self, station, scheduler=None, lease=None, wakeup=None, queue_size=1, stale_policy='replace',
+                 stats=None, rediscover=None, rediscover_after=3):
+        self.station = station
+        self.rediscover = rediscover
+        self.rediscover_after = rediscover_after
+        self.scheduler = scheduler if scheduler is not None else PollScheduler(station.poll_interval)
+        self.wakeup = wakeup
+        self.stale_policy = stale_policy
+        self.stats = stats if stats is not None else DriverStats()
+        self.lease = lease if lease is not None else BroadcastLease(station.http, station.real_rime_url,
+                                                                    stats=self.stats)
+
+        self.queue = queue.Queue(queue_size)
+        self.event = threading.Event()
+        self.stopped = False
+        self.rescheduled = False
+        self.thread = None
+        # Failed polls and broadcast requests in a row
+        self.failures = 0
+
+    def start(self):
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='WLL HTTP poller')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(10)
+        self.thread = None
+
+    def reschedule(self):
+        """Ask the poller to recompute the next poll, after the scheduler shortened its interval."""
+        self.rescheduled = True
+        self.event.set()
+
+    def results(self):
+        while True:
+            try:
+                yield self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.stale_policy == 'drop':
+                self.stats.count('http_results_dropped')
+                return
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.stats.count('http_results_replaced')
+            self.queue.put_nowait(item)
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def run(self):
+        next_poll = time.monotonic()
+        while True:
+            wake = min(next_poll, self.lease.deadline(self.station.last_datagram))
+            self.event.wait(max(wake - time.monotonic(), 0))
+            self.event.clear()
+            if self.stopped:
+                break
+
+            # Keep UDP on
+            lease_failures = self.lease.failures
+            self.lease.check(self.station.last_datagram)
+            if self.lease.failures > lease_failures:
+                self.failures += 1
+            self.check_failures()
+
+            # Checkpoint the rain state here rather than in the driver loop
+            self.station.rainbarrel.flush()
+
+            if self.rescheduled:
+                self.rescheduled = False
+                next_poll = min(next_poll, self.scheduler.next_poll())
+
+            if time.monotonic() < next_poll:
+                continue
+            # No polls in the midnight window, see PollScheduler
+            next_poll = self.scheduler.next_poll()
+
+            # Get Current Conditions
+            response = self.station.http.request(self.station.current_conditions_url)
+            self.failures = 0 if response is not None else self.failures + 1
+            self.put((time.monotonic(), response))
+            self.check_failures()
+
+    def check_failures(self):
+        if self.rediscover is not None and self.failures >= self.rediscover_after:
+            self.failures = 0
+            self.rediscover(self.station)
+
+
+class PacketCoalescer:
+    """Merges UDP wind/rain packets into the latest HTTP observation.
+
+    A UDP packet arriving less than window seconds after the last emitted
+    packet is held and merged into the next one instead of being emitted.
+    Packets whose observations did not change are dropped, and max_rate limits
+    the number of packets per second. The rain of held and dropped packets is
+    added to the next emitted packet, so no rain is lost, and the highest wind
+    speed seen while holding is reported as windGust.
+    """
 
-            data = response['data']
+    def __init__(self, window=10, max_rate=0, stats=None):
+        self.window = window
+        self.min_interval = 1.0 / max_rate if max_rate else 0
+        self.stats = stats if stats is not None else DriverStats()
 
-            main_condition = data['conditions'][0]
-            self.station.set_txid(data['conditions'][0]['txid'])
+        self.snapshot = dict()
+        self.last_fields = None
+        self.last_emit = -float('inf')
 
-            # Set Bucket Size
-            self.station.rainbarrel.set_up_bucket_size(main_condition)
+        self.rain = 0
+        self.gust = None
+        self.gust_dir = None
+
+    def add(self, packet, udp=False, now=None):
+        """Return the packet to yield for packet, or None if it was held or dropped."""
+        now = time.monotonic() if now is None else now
+
+        if udp:
+            merged = dict(self.snapshot)
+            merged.update(packet)
+        else:
+            self.snapshot = packet
+            merged = dict(packet)
+
+        self.rain += packet.get('rain') or 0
+        speed = packet.get('windSpeed')
+        if speed is not None and (self.gust is None or speed > self.gust):
+            self.gust = speed
+            self.gust_dir = packet.get('windDir')
+
+        since_emit = now - self.last_emit
+        if since_emit < self.min_interval or (udp and since_emit < self.window and not self.rain):
+            self.stats.count('packets_coalesced')
+            return None
+
+        fields = dict((name, value) for name, value in merged.items() if name not in ('dateTime', 'rain'))
+        if fields == self.last_fields and not self.rain:
+            self.stats.count('packets_unchanged')
+            return None
+
+        merged['rain'] = self.rain
+        if self.gust is not None and self.gust > (merged.get('windGust') or 0):
+            merged['windGust'] = self.gust
+            merged['windGustDir'] = self.gust_dir
+
+        self.rain = 0
+        self.gust = None
+        self.gust_dir = None
+        self.last_emit = now
+        self.last_fields = fields
+        return merged
 
-            # Check current rain for the day and set it
-            self.station.rainbarrel.set_rain_previous_period(main_condition['rainfall_daily'])
 
-            # Set date for previous rain
-            self.station.rainbarrel.set_rain_previous_date(datetime.datetime.fromtimestamp(data['ts']))
+class WeatherLinkLiveUDPDriver(weewx.drivers.AbstractDevice):
+    """weewx driver that reads data from a WeatherLink Live
+    """
+
+    def __init__(self, **stn_dict):
+        # Show Diver version
+        loginf('WLL UDP driver version is %s' % DRIVER_VERSION)
+        loginf('JSON backend is {}'.format(set_json_backend(stn_dict.get('json_backend', 'auto'))))
+
+        self.stats = DriverStats()
+        # Seconds between the summary log lines, 0 is never
+        self.stats_interval = float(stn_dict.get('stats_interval', 3600)) or float('inf')
+        self.stats_server = None
+        if stn_dict.get('stats_port') or stn_dict.get('stats_socket'):
+            self.stats_server = StatsServer(self.stats,
+                                            port=int(stn_dict.get('stats_port', 0)),
+                                            path=stn_dict.get('stats_socket'))
+            self.stats_server.start()
+
+        self.recorder = None
+        if stn_dict.get('capture_file'):
+            self.recorder = PayloadRecorder(stn_dict['capture_file'],
+                                            max_bytes=int(stn_dict.get('capture_max_bytes', 10 * 1024 * 1024)),
+                                            backups=int(stn_dict.get('capture_backups', 5)))
+            loginf('Recording raw payloads to {}'.format(stn_dict['capture_file']))
+
+        self.publisher = None
+        sinks = open_sinks(stn_dict)
+        if sinks:
+            self.publisher = PacketPublisher(sinks,
+                                             queue_size=int(stn_dict.get('publish_queue_size', 1000)),
+                                             batch_size=int(stn_dict.get('publish_batch_size', 50)))
+            loginf('Publishing packets to {}'.format(', '.join(type(sink).__name__ for sink in sinks)))
+
+        # The primary WLL, plus any others in the [[stations]] section
+        station_dicts = stn_dict.get('stations') or dict()
+
+        self.http = WllHttpClient(pool_size=int(stn_dict.get('http_pool_size', 1)),
+                                  timeout=float(stn_dict.get('http_timeout', 3)),
+                                  retries=int(stn_dict.get('http_retries', 3)),
+                                  backoff_factor=float(stn_dict.get('http_backoff_factor', 1)),
+                                  hosts=1 + len(station_dicts),
+                                  stats=self.stats)
+
+        self.http.recorder = self.recorder
+
+        # Sleep for 5 seconds at midnight
+        self.midnight = MidnightWindow(5)
+
+        self.http_queue_size = int(stn_dict.get('http_queue_size', 1))
+        self.http_stale_policy = stn_dict.get('http_stale_policy', 'replace')
+        if self.http_stale_policy not in ('replace', 'drop'):
+            logerr('Unknown http_stale_policy {}, using replace'.format(self.http_stale_policy))
+            self.http_stale_policy = 'replace'
+        # Failed polls and broadcast requests before a station with wll_ip = auto is looked for again
+        self.rediscover_after = int(stn_dict.get('rediscover_after', 3))
+
+        self.stats.gauges['http_requests'] = lambda: self.http.requests
+        self.stats.gauges['http_failures'] = lambda: self.http.failures
+        self.stats.gauges['http_connections_new'] = lambda: self.http.connections_new
+        self.stats.gauges['http_connections_reused'] = lambda: self.http.connections_reused
+        if self.recorder is not None:
+            self.stats.gauges['capture_recorded'] = lambda: self.recorder.recorded
+            self.stats.gauges['capture_dropped'] = lambda: self.recorder.dropped
+        if self.publisher is not None:
+            self.stats.gauges['published'] = lambda: self.publisher.published
+            self.stats.gauges['publish_dropped'] = lambda: self.publisher.dropped
+            self.stats.gauges['publish_errors'] = lambda: self.publisher.errors
+        self.stats.gauges['stations'] = lambda: dict(
+            (station.name or 'primary', {'address': station.address, 'udp_datagrams': station.udp_datagrams,
+                                         'poll_interval': station.scheduler.interval,
+                                         'broadcast_expires_in': round(station.lease.expires - time.monotonic(), 1),
+                                         'wind': station.wind.as_dict() if station.wind is not None else None,
+                                         'rejected': dict(station.quality.rejected)
+                                         if station.quality is not None else None})
+            for station in self.stations)
+
+        # The UDP socket is only opened once the loop starts, see open_udp_socket()
+        self.udp_socket = None
+        self.udp_bind_address = stn_dict.get('udp_bind_address', '')
+        self.udp_port = int(stn_dict.get('udp_port', 22222))
+        self.udp_reuse = weeutil.weeutil.to_bool(stn_dict.get('udp_reuse', False))
+        self.udp_buffer_size = int(stn_dict.get('udp_buffer_size', 0))
+
+        self.wll_ip = stn_dict.get('wll_ip', '192.168.1.47')
+        self.wll_port = int(stn_dict.get('wll_port', 80))
+
+        self.stations = []
+        self.add_station('', stn_dict, stn_dict)
+        for name, options in station_dicts.items():
+            self.add_station(name, options, stn_dict)
+        self.station = self.stations[0]
+
+        # UDP broadcasts are demultiplexed by their source address
+        self.stations_by_address = dict((station.address, station) for station in self.stations)
+
+    def add_station(self, name, options, defaults):
+        """Set up a WllStation. The primary station has no name and takes its
+        options from the driver stanza; the others inherit poll_interval,
+        wll_port and the coalescing options from it."""
+        wll_ip = options.get('wll_ip', None if name else '192.168.1.47')
+        if wll_ip is None:
+            logerr("No Weatherlink Live IP provided for station {}".format(name))
+            return
+
+        def inherited(key, default):
+            return options.get(key, defaults.get(key, default))
+
+        station = WllStation(self.http, self.stats)
+        station.name = name
+        wll_port = int(inherited('wll_port', 80))
+
+        if name and defaults.get('state_file'):
+            station.rainbarrel.state_file = options.get('state_file', '{}.{}'.format(defaults['state_file'], name))
+        else:
+            station.rainbarrel.state_file = options.get('state_file')
+        station.rainbarrel.save_interval = float(inherited('state_interval', 60))
+        station.profile_file = options.get('profile_file', station.rainbarrel.state_file + '.profile'
+                                           if station.rainbarrel.state_file else None)
+        profile = StationProfile.load(station.profile_file)
+
+        if wll_ip == 'auto':
+            mdns_address = inherited('mdns_address', None)
+            if mdns_address:
+                host, _, port = mdns_address.rpartition(':')
+                mdns_address = (host, int(port))
+            station.discovery = {'timeout': float(inherited('discovery_timeout', 5)), 'udp_port': self.udp_port,
+                                 'mdns_address': mdns_address or MDNS_ADDRESS}
+            if profile is not None and profile.address:
+                wll_ip, wll_port = profile.address, profile.port
+                loginf('Using the WLL at {}:{} from {}'.format(wll_ip, wll_port, station.profile_file))
+            else:
+                # Leave the units that other stations use alone
+                taken = set(station.address for station in self.stations)
+                found = [device for device in discover(**station.discovery) if device['address'] not in taken]
+                if not found:
+                    if not name:
+                        raise weewx.ViolatedPrecondition('No Weatherlink Live found on the LAN')
+                    logerr('No Weatherlink Live found for station {}'.format(name))
+                    return
+                wll_ip, wll_port = found[0]['address'], found[0]['port']
+                loginf('Found {} at {}:{}'.format(found[0]['name'], wll_ip, wll_port))
+        # Fields of the other stations are prefixed, e.g. garden_outTemp
+        station.field_prefix = options.get('field_prefix', '{}_'.format(name) if name else '')
+        station.broadcast_duration = int(inherited('broadcast_duration', 3600))
+        station.set_address(wll_ip, wll_port)
+        if name:
+            loginf('Station {} is at {}, fields are prefixed with {}'.format(name, wll_ip, station.field_prefix))
+
+        if profile is not None and (profile.address, profile.port) != (station.address, wll_port):
+            # Cached for another WLL
+            profile = None
+
+        station.set_poll_interval(float(inherited('poll_interval', 10)))
+        if weeutil.weeutil.to_bool(inherited('adaptive_poll', False)):
+            station.scheduler = AdaptivePollScheduler(float(inherited('poll_interval_min', station.poll_interval)),
+                                                      float(inherited('poll_interval_max', 300)),
+                                                      self.midnight)
+            loginf('HTTP polling interval adapts between {} and {} s'
+                   .format(station.scheduler.floor, station.scheduler.ceiling))
+        else:
+            station.scheduler = PollScheduler(station.poll_interval, self.midnight)
+
+        station.set_extra1(options.get('extra_id'))
+        station.set_sensor_map(options.get('sensor_map'))
+
+        station.lease = BroadcastLease(self.http, station.real_rime_url,
+                                       margin=float(inherited('broadcast_margin', 360)),
+                                       loss_timeout=float(inherited('broadcast_loss_timeout', 10)),
+                                       backoff_max=float(inherited('broadcast_backoff_max', 300)),
+                                       stats=self.stats)
+
+        if weeutil.weeutil.to_bool(inherited('coalesce', False)):
+            station.coalescer = PacketCoalescer(window=float(inherited('coalesce_window', 10)),
+                                                max_rate=float(inherited('max_emit_rate', 0)),
+                                                stats=self.stats)
+
+        if weeutil.weeutil.to_bool(inherited('quality_filter', False)):
+            station.quality = QualityFilter(ranges=inherited('quality_ranges', None),
+                                            rates=inherited('quality_rates', None),
+                                            stats=self.stats)
+
+        if weeutil.weeutil.to_bool(inherited('wind_sampling', False)):
+            station.wind = WindSampler(size=int(inherited('wind_buffer_size', 256)),
+                                       gust_window=float(inherited('wind_gust_window', 120)),
+                                       avg_window=float(inherited('wind_avg_window', 600)))
+
+        self.stations.append(station)
+
+        restored = station.rainbarrel.load_state()
+        if restored or profile is not None:
+            # Start right away; the first poll reconciles the state with the WLL
+            if profile is not None:
+                profile.apply(station)
+                station.profile = profile
+            if restored:
+                station.set_txid(station.rainbarrel.txid)
+            if profile is None:
+                station.build_decoder()
+            station.reconcile_pending = True
+            return
+
+        # Make First Contact with WLL
+        response = self.http.request(station.current_conditions_url)
+
+        if response is None:
+            logerr('Unable to connect to Weather Link Live')
+            station.build_decoder()
+            station.reconcile_pending = True
+        elif response.get('data'):
+            station.set_up_station(response['data'])
+
+    def rediscover(self, station):
+        """Look for the WLL of a station with wll_ip = auto again, after it
+        stopped answering, e.g. because it got a new DHCP lease. Runs on the
+        poller thread of the station. Returns True when it was found."""
+        taken = set(other.address for other in self.stations if other is not station)
+        if station.moved_to is not None:
+            # Its broadcast already comes from there, see source_station()
+            devices = [{'address': station.moved_to, 'port': station.port}]
+        else:
+            # The driver holds the UDP port, so only ask over mDNS
+            devices = discover(**dict(station.discovery, udp_port=None))
+        station.moved_to = None
+        for device in devices:
+            if device['address'] in taken or (device['address'], device['port']) == (station.address, station.port):
+                continue
+            response = self.http.request('http://{}:{}/v1/current_conditions'.format(device['address'],
+                                                                                     device['port']))
+            if response is None or not response.get('data'):
+                continue
+            if station.profile is not None and station.profile.did not in (None, response['data'].get('did')):
+                # Another WLL on the LAN
+                continue
+            loginf('WLL of station {} moved from {} to {}:{}'.format(station.name or 'primary', station.address,
+                                                                     device['address'], device['port']))
+            station.set_address(device['address'], device['port'])
+            station.update_profile(response['data'])
+            self.stations_by_address = dict((station.address, station) for station in self.stations)
+            self.stats.count('rediscoveries')
+            return True
+        logerr('WLL of station {} not found on the LAN'.format(station.name or 'primary'))
+        return False
+
+    def source_station(self, address, data):
+        """The station a datagram from an unknown address belongs to, or None.
+
+        A WLL that got another address keeps broadcasting until its lease ends.
+        When the did of the datagram is that of a station with wll_ip = auto,
+        the address is noted for rediscover() and the datagrams are decoded
+        for the station in the meantime.
+        """
+        try:
+            did = parse_json(data).get('did')
+        except (ValueError, AttributeError):
+            return None
+        for station in self.stations:
+            if station.discovery and station.profile is not None and did and station.profile.did == did:
+                if station.moved_to != address:
+                    loginf('Broadcast of the WLL of station {} comes from {}'.format(station.name or 'primary',
+                                                                                       address))
+                    station.moved_to = address
+                return station
+        return None
 
     @property
     def hardware_name(self):
         return "WeatherLinkLiveUDP"
 
-    def test_midnight(self):
-        now = datetime.datetime.now()
-        current_time = now.strftime("%H:%M:%S")
-        start = '00:00:00'
-        end = '00:00:05'
-        if start < current_time < end:
-            logdbg('Midnight nap')
-            logdbg(current_time)
-            return True
-        else:
-            return False
+    def open_udp_socket(self):
+        if self.udp_socket is None:
+            udp_socket = socket.socket(AF_INET, SOCK_DGRAM)
+            if self.udp_reuse:
+                # Let other listeners (another driver, a test harness) share the port
+                udp_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+                if hasattr(socket, 'SO_REUSEPORT'):
+                    udp_socket.setsockopt(SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if self.udp_buffer_size:
+                udp_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, self.udp_buffer_size)
+            udp_socket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+            udp_socket.bind((self.udp_bind_address, self.udp_port))
+            udp_socket.setblocking(False)
+            self.udp_socket = udp_socket
+            logdbg('Listening for UDP broadcast on {}:{}'.format(self.udp_bind_address or '*', self.udp_port))
+        return self.udp_socket
+
+    def closePort(self):
+        if self.udp_socket is not None:
+            self.udp_socket.close()
+            self.udp_socket = None
+        for station in self.stations:
+            if station.rainbarrel.dirty:
+                station.rainbarrel.save_state()
+        self.log_stats()
+        if self.stats_server is not None:
+            self.stats_server.stop()
+            self.stats_server = None
+        self.http.close()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
 
     def genLoopPackets(self):
-
-        # Start Loop
-        while True:
-            # Sleep for 5 seconds at midnight
-            if self.test_midnight():
-                logdbg("Midnight, no HTTP packet.")
-            else:
-                # Get Current Conditions
-                current_conditions = make_request_using_socket(self.station.current_conditions_url)
-                if current_conditions is None:
-                    logerr('No current conditions from wll. Check ip address.')
-                elif current_conditions.get('data'):
-                    packet = self.station.decode_data_wll(current_conditions['data'])
-                    yield packet
-
-            # Check if UDP is still on
-            self.station.check_udp_broascast()
-
-            # Set timer to listen to UDP
-            self.timeout = time.time() + self.station.poll_interval
-
-            # Listen for UDP Broadcast for the duration of the poll interval
-            while time.time() < self.timeout:
-                try:
-                    data, wherefrom = comsocket.recvfrom(2048)
-                    UDP_data = json.loads(data.decode("utf-8"))
+        # UDP datagrams and HTTP responses are multiplexed on one selector. The
+        # HTTP requests run on a poller thread per station, which wakes the
+        # selector through a socket pair once a response is queued.
+        udp_socket = self.open_udp_socket()
+        selector = selectors.DefaultSelector()
+        wakeup_recv, wakeup_send = socket.socketpair()
+        wakeup_recv.setblocking(False)
+        selector.register(udp_socket, selectors.EVENT_READ, 'udp')
+        selector.register(wakeup_recv, selectors.EVENT_READ, 'http')
+
+        pollers = []
+        pollers_by_station = dict()
+        for station in self.stations:
+            poller = HttpPoller(station, scheduler=station.scheduler, lease=station.lease,
+                                wakeup=lambda: wakeup_send.send(b'\0'),
+                                queue_size=self.http_queue_size, stale_policy=self.http_stale_policy,
+                                stats=self.stats,
+                                rediscover=self.rediscover if station.discovery else None,
+                                rediscover_after=self.rediscover_after)
+            poller.start()
+            pollers.append(poller)
+            pollers_by_station[station] = poller
+            station.last_udp = station.last_datagram = time.monotonic()
+
+        next_report = time.monotonic() + self.stats_interval
+
+        try:
+            # Start Loop
+            while True:
+                now = time.monotonic()
+                for poller in pollers:
+                    if now - poller.station.last_udp > UDP_TIMEOUT:
+                        logerr('UDP Socket Time Out')
+                        self.stats.count('udp_timeouts')
+                        poller.station.last_udp = now
+                        # The poller requests the broadcast again, see BroadcastLease
+                        if poller.station.scheduler.udp_silent():
+                            poller.reschedule()
+
+                if now >= next_report:
+                    next_report = now + self.stats_interval
+                    self.log_stats()
+
+                timeout = min(min(station.last_udp for station in self.stations) + UDP_TIMEOUT,
+                              next_report) - time.monotonic()
+                events = selector.select(max(timeout, 0))
+                # Time spent on the engine thread outside of select() is stall time
+                busy = time.perf_counter()
+                for key, _ in events:
+                    if key.data == 'http':
+                        wakeup_recv.recv(64)
+                        for poller in pollers:
+                            station = poller.station
+                            for arrival, current_conditions in poller.results():
+                                if current_conditions is None:
+                                    logerr('No current conditions from wll. Check ip address.')
+                                elif current_conditions.get('data'):
+                                    if station.reconcile_pending:
+                                        station.reconcile(current_conditions['data'])
+                                    start = time.perf_counter()
+                                    packet = station.decode_data_wll(current_conditions['data'])
+                                    self.stats.decode.add(time.perf_counter() - start)
+                                    udp_healthy = time.monotonic() - station.last_datagram <= UDP_TIMEOUT
+                                    if station.scheduler.observe(packet, udp_healthy=udp_healthy):
+                                        poller.reschedule()
+                                    packet = self.finish_packet(station, packet)
+                                    if packet is not None:
+                                        self.stats.http_yield_latency.add(time.monotonic() - arrival)
+                                        self.stats.engine_stall.add(time.perf_counter() - busy)
+                                        yield packet
+                                        busy = time.perf_counter()
+                        continue
+
+                    # Listen for UDP Broadcast
+                    try:
+                        start = time.perf_counter()
+                        data, wherefrom = udp_socket.recvfrom(2048)
+                        self.stats.udp_receive.add(time.perf_counter() - start)
+                    except BlockingIOError:
+                        continue
+                    arrival = time.monotonic()
+                    self.stats.count('udp_datagrams')
+                    station = self.stations_by_address.get(wherefrom[0])
+                    if station is None:
+                        station = self.source_station(wherefrom[0], data)
+                    if station is None:
+                        if len(self.stations) > 1:
+                            self.stats.count('udp_unknown_source')
+                            continue
+                        station = self.station
+                    station.last_udp = station.last_datagram = arrival
+                    station.udp_datagrams += 1
+                    if self.recorder is not None:
+                        self.recorder.record('udp', data)
+                    try:
+                        start = time.perf_counter()
+                        UDP_data = parse_json(data)
+                        self.stats.json_parse.add(time.perf_counter() - start)
+                    # Catch json decoder faults
+                    except ValueError:
+                        self.stats.count('json_errors')
+                        continue
                     if UDP_data["conditions"] is None:
                         logdbg(UDP_data["error"])
+                    elif self.midnight.contains(time.time()):
+                        logdbg("Midnight, no UDP packet.")
                     else:
-                        if self.test_midnight():
-                            logdbg("Midnight, no UDP packet.")
-                        else:
-                            packet = self.station.decode_data_wll(UDP_data)
+                        start = time.perf_counter()
+                        packet = station.decode_data_wll(UDP_data, udp=True)
+                        self.stats.decode.add(time.perf_counter() - start)
+                        self.stats.count('udp_decoded')
+                        if station.scheduler.observe(packet, udp=True):
+                            pollers_by_station[station].reschedule()
+                        packet = self.finish_packet(station, packet, udp=True)
+                        if packet is not None:
+                            self.stats.udp_yield_latency.add(time.monotonic() - arrival)
+                            self.stats.engine_stall.add(time.perf_counter() - busy)
                             # Yield UDP
                             yield packet
-                # Catch json decoder faults
-                except json.JSONDecodeError:
-                    logging.info(
-                        "Message was ignored because it was not valid JSON.",
-                    )
+                            busy = time.perf_counter()
+                self.stats.engine_stall.add(time.perf_counter() - busy)
+        finally:
+            for poller in pollers:
+                poller.stop()
+            selector.close()
+            wakeup_recv.close()
+            wakeup_send.close()
+
+    def finish_packet(self, station, packet, udp=False):
+        """Turn a decoded packet of station into a LOOP packet, published,
+        coalesced and prefixed. Returns None when the packet is not to be yielded."""
+        if self.publisher is not None:
+            # Every packet is published, also the ones that are coalesced away
+            self.publisher.publish(dict(packet), station.name)
+        if station.coalescer is not None:
+            packet = station.coalescer.add(packet, udp=udp)
+            if packet is None:
+                return None
+        if station.last_yielded is not None and packet['dateTime'] < station.last_yielded:
+            # An HTTP response handled after a newer datagram. WeeWX wants the
+            # LOOP packets in time order: its wind is outdated, the rest of its
+            # observations goes with the next packet.
+            self.stats.count('packets_out_of_order')
+            for name, value in packet.items():
+                if name == 'rain':
+                    station.held['rain'] = station.held.get('rain', 0) + (value or 0)
+                elif name not in ('dateTime', 'usUnits') and not name.startswith('wind'):
+                    station.held[name] = value
+            return None
+        if station.held:
+            rain = station.held.pop('rain', 0)
+            for name, value in station.held.items():
+                packet.setdefault(name, value)
+            if rain:
+                packet['rain'] = (packet.get('rain') or 0) + rain
+            station.held = dict()
+        station.last_yielded = packet['dateTime']
+        if station.field_prefix:
+            prefix = station.field_prefix
+            packet = dict((name if name in ('dateTime', 'usUnits') else prefix + name, value)
+                          for name, value in packet.items())
+        return packet
 
+    def log_stats(self):
+        loginf('Stats: {}'.format(self.stats.summary()))
+
+
+def synthetic_data(ts, udp=False, txid=1, rainfall_daily=0):
+    """Build a current_conditions (or, with udp, a real-time broadcast) data
+    record shaped like the ones a WLL with an ISS sends."""
+    if udp:
+        return {
+            'did': '001D0A700000',
+            'ts': ts,
+            'conditions': [{
+                'lsid': 1, 'data_structure_type': ISS_CURRENT_CONDITIONS, 'txid': txid,
+                'wind_speed_last': 4.0, 'wind_dir_last': 220,
+                'rain_size': 2, 'rain_rate_last': 0, 'rainfall_last_60_min': 0,
+                'rainfall_last_24_hr': 0, 'rainfall_daily': rainfall_daily,
+                'rain_storm': 0, 'rain_storm_start_at': None,
+            }],
+        }
+    return {
+        'did': '001D0A700000',
+        'ts': ts,
+        'conditions': [{
+            'lsid': 1, 'data_structure_type': ISS_CURRENT_CONDITIONS, 'txid': txid,
+            'temp': 62.7, 'hum': 71.3, 'dew_point': 53.2, 'wet_bulb': 56.6,
+            'heat_index': 62.8, 'wind_chill': 62.7, 'thw_index': 62.8, 'thsw_index': 61.4,
+            'wind_speed_last': 3.0, 'wind_dir_last': 210,
+            'wind_speed_avg_last_1_min': 2.5, 'wind_dir_scalar_avg_last_1_min': 205,
+            'wind_speed_avg_last_2_min': 2.6, 'wind_dir_scalar_avg_last_2_min': 207,
+            'wind_speed_hi_last_2_min': 6.0, 'wind_dir_at_hi_speed_last_2_min': 215,
+            'wind_speed_avg_last_10_min': 2.4, 'wind_dir_scalar_avg_last_10_min': 200,
+            'wind_speed_hi_last_10_min': 8.0, 'wind_dir_at_hi_speed_last_10_min': 220,
+            'rain_size': 2, 'rain_rate_last': 0, 'rain_rate_hi': 0,
+            'rainfall_last_15_min': 0, 'rain_rate_hi_last_15_min': 0,
+            'rainfall_last_60_min': 0, 'rainfall_last_24_hr': 0,
+            'rain_storm': 0, 'rain_storm_start_at': None,
+            'solar_rad': 312, 'uv_index': 1.8, 'rx_state': 0, 'trans_battery_flag': 0,
+            'rainfall_daily': rainfall_daily, 'rainfall_monthly': 0, 'rainfall_year': 0,
+            'rain_storm_last': 0, 'rain_storm_last_start_at': None, 'rain_storm_last_end_at': None,
+        }, {
+            'lsid': 2, 'data_structure_type': LSS_BAR_CURRENT_CONDITIONS,
+            'bar_sea_level': 30.008, 'bar_trend': 0.012, 'bar_absolute': 29.852,
+        }, {
+            'lsid': 3, 'data_structure_type': LSS_TEMP_HUM_CURRENT_CONDITIONS,
+            'temp_in': 71.1, 'hum_in': 45.0, 'dew_point_in': 48.6, 'heat_index_in': 69.9,
+        }],
+    }
+
+
+def measure_decode(count=20000, repeat=5):
+    """The cost of decode_data_wll() in us per HTTP and per UDP packet (best of repeat runs)."""
+    import timeit
+
+    station = WllStation(None)
+    data = synthetic_data(int(time.time()))
+    station.set_up_station(data)
+
+    costs = dict()
+    for label, data, udp in (('HTTP', data, False),
+                             ('UDP', synthetic_data(data['ts'], udp=True), True)):
+        timer = timeit.Timer(lambda: station.decode_data_wll(data, udp=udp))
+        costs[label] = min(timer.repeat(repeat, count)) / count * 1e6
+    return costs
+
+
+def bench_decode(count=20000, repeat=5):
+    """Print the cost of decode_data_wll() per HTTP and per UDP packet (best of repeat runs)."""
+    for label, cost in measure_decode(count, repeat).items():
+        print('decode_data_wll {}: {:.2f} us/packet'.format(label, cost))
+
+
+def bench_alloc(capture=None, count=4000):
+    """Print the memory allocated per LOOP packet while decoding a session,
+    measured with tracemalloc.
+
+    The session is a capture (see read_capture_data()) or, without one, count
+    synthetic data records: a UDP broadcast every 2.5 s and an HTTP poll every 10 s.
+    """
+    import tracemalloc
+
+    if capture:
+        session = [(source, data) for _, source, data in read_capture_data(capture)]
+    else:
+        start = int(time.time())
+        session = [('http', synthetic_data(start + i * 2.5)) if i % 4 == 0 else
+                   ('udp', synthetic_data(start + i * 2.5, udp=True, rainfall_daily=i // 40))
+                   for i in range(count)]
+
+    station = WllStation(None)
+    setup = next((data for source, data in session if source == 'http'), None)
+    if setup is None:
+        print('No current_conditions response in the session')
+        return
+    station.set_up_station(setup)
+    session = [(source == 'udp', data) for source, data in session if data.get('conditions')]
+
+    # Warm up, so that caches and the decoder are not counted
+    for udp, data in session[:10]:
+        station.decode_data_wll(data, udp=udp)
+
+    tracemalloc.start()
+    # Transient memory: the high water mark above the baseline of every decode
+    transient = 0
+    for udp, data in session:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        station.decode_data_wll(data, udp=udp)
+        transient += tracemalloc.get_traced_memory()[1] - baseline
+
+    # Retained memory: the blocks of the packets that are handed to WeeWX
+    before = tracemalloc.take_snapshot()
+    packets = [station.decode_data_wll(data, udp=udp) for udp, data in session]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in retained)
+    size = sum(stat.size_diff for stat in retained)
+
+    print('{} packets'.format(len(packets)))
+    print('peak allocated per packet:     {:.0f} bytes'.format(transient / len(session)))
+    print('retained per packet:           {:.1f} blocks, {:.0f} bytes'
+          .format(blocks / len(packets), size / len(packets)))
+
+
+class WllEmulator:
+    """Local stand-in for a WeatherLink Live.
+
+    Serves /v1/current_conditions and /v1/real_time over HTTP and broadcasts the
+    real-time UDP packets to udp_address:udp_port. Without a capture the data is
+    synthetic; a capture is either recorded by PayloadRecorder or a file with one
+    JSON object per line, {"ts": <receive time>, "source": "udp" | "http",
+    "data": <WLL data record>}. It is replayed at speed times real time (0 is as fast as possible).
+    With mdns_port it also answers mDNS queries for _weatherlinklive._tcp on that port.
+    """
+
+    def __init__(self, http_port=0, udp_port=22222, udp_address='127.0.0.1',
+                 interval=2.5, speed=1.0, capture=None, rain_every=10, address='127.0.0.1', mdns_port=None):
+        # Address the HTTP server listens on and the broadcasts are sent from
+        self.address = address
+        self.http_port = http_port
+        self.udp_port = udp_port
+        self.udp_address = udp_address
+        self.interval = interval
+        self.speed = speed
+        self.capture = capture
+        # Synthetic data tips the bucket once every rain_every broadcasts
+        self.rain_every = rain_every
+        self.mdns_port = mdns_port
+
+        self.rainfall_daily = 0
+        self.current_conditions = synthetic_data(int(time.time()))
+        self.sent = 0
+        self.http_requests = 0
+
+        self.server = None
+        self.stopped = threading.Event()
+        self.finished = threading.Event()
+        self.threads = []
+
+    def start(self, broadcast=True):
+        import http.server
+
+        emulator = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                emulator.http_requests += 1
+                if self.path.startswith('/v1/current_conditions'):
+                    body = {'data': emulator.current_conditions, 'error': None}
+                elif self.path.startswith('/v1/real_time'):
+                    duration = int(self.path.partition('duration=')[2] or 3600)
+                    body = {'data': {'broadcast_port': emulator.udp_port, 'duration': duration}, 'error': None}
+                else:
+                    self.send_error(404)
+                    return
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((self.address, self.http_port), Handler)
+        self.server.daemon_threads = True
+        self.http_port = self.server.server_address[1]
+        self.stopped.clear()
+        self.start_thread(self.server.serve_forever)
+        loginf('WLL emulator on http://{}:{}'.format(self.address, self.http_port))
+        if self.mdns_port is not None:
+            self.start_mdns()
+        if broadcast:
+            self.start_broadcast()
+
+    def start_broadcast(self):
+        self.start_thread(self.replay if self.capture else self.synthesize)
+        loginf('WLL emulator broadcasting to {}:{}'.format(self.udp_address, self.udp_port))
+
+    def start_mdns(self):
+        mdns_socket = socket.socket(AF_INET, SOCK_DGRAM)
+        mdns_socket.bind((self.address, self.mdns_port))
+        mdns_socket.settimeout(0.5)
+        self.mdns_port = mdns_socket.getsockname()[1]
+        self.start_thread(lambda: self.answer_mdns(mdns_socket))
+        loginf('WLL emulator answering mDNS on {}:{}'.format(self.address, self.mdns_port))
+
+    def answer_mdns(self, mdns_socket):
+        """Answer PTR queries for the WLL service with its PTR, SRV and A records."""
+        instance = encode_dns_name('{}.{}'.format(self.current_conditions['did'], MDNS_SERVICE))
+        host = encode_dns_name('wll-emulator.local')
+        srv = struct.pack('!HHH', 0, 0, self.http_port) + host
+        records = [(encode_dns_name(MDNS_SERVICE), DNS_PTR, instance),
+                   (instance, DNS_SRV, srv),
+                   (host, DNS_A, socket.inet_aton(self.address))]
+        answer = b''.join(name + struct.pack('!HHIH', record_type, 1, 120, len(value)) + value
+                          for name, record_type, value in records)
+        try:
+            while not self.stopped.is_set():
+                try:
+                    query, source = mdns_socket.recvfrom(4096)
                 except socket.timeout:
-                    logerr('UDP Socket Time Out')
-                    # Reset Countdown to Switch UDP back on.
-                    self.station.udp_countdown = 0
-                    self.station.check_udp_broascast()
+                    continue
+                if encode_dns_name(MDNS_SERVICE) not in query.lower():
+                    continue
+                mdns_socket.sendto(query[:2] + struct.pack('!5H', 0x8400, 0, 1, 0, 2) + answer, source)
+        finally:
+            mdns_socket.close()
+
+    def start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join(5)
+
+    def open_udp_socket(self):
+        udp_socket = socket.socket(AF_INET, SOCK_DGRAM)
+        udp_socket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+        udp_socket.bind((self.address, 0))
+        return udp_socket
+
+    def broadcast(self, udp_socket, data):
+        udp_socket.sendto(json.dumps(data).encode('utf-8'), (self.udp_address, self.udp_port))
+        self.sent += 1
+
+    def synthesize(self):
+        udp_socket = self.open_udp_socket()
+        start = time.time()
+        count = 0
+        try:
+            while not self.stopped.is_set():
+                # Device time runs at speed times real time
+                ts = int(start + count * self.interval)
+                if self.rain_every and count % self.rain_every == 0:
+                    self.rainfall_daily += 1
+                self.current_conditions = synthetic_data(ts, rainfall_daily=self.rainfall_daily)
+                self.broadcast(udp_socket, synthetic_data(ts, udp=True, rainfall_daily=self.rainfall_daily))
+                count += 1
+                if self.speed > 0:
+                    self.stopped.wait(self.interval / self.speed)
+        finally:
+            udp_socket.close()
+
+    def replay(self):
+        udp_socket = self.open_udp_socket()
+        first = None
+        start = time.time()
+        try:
+            for ts, source, data in read_capture_data(self.capture):
+                if self.stopped.is_set():
+                    break
+                if first is None:
+                    first = ts
+                if self.speed > 0:
+                    delay = start + (ts - first) / self.speed - time.time()
+                    if delay > 0:
+                        self.stopped.wait(delay)
+                if source == 'udp':
+                    self.broadcast(udp_socket, data)
+                else:
+                    self.current_conditions = data
+        finally:
+            udp_socket.close()
+            self.finished.set()
+        loginf('WLL emulator finished replaying {}'.format(self.capture))
+
+
+def bench_json(capture=None, count=20000, repeat=5):
+    """Print the parse cost per datagram of each installed JSON backend, on the
+    payloads of a capture or on synthetic payloads."""
+    import timeit
+
+    if capture:
+        payloads = [payload for _, source, payload in read_capture(capture) if source != 'real_time']
+    else:
+        payloads = [json.dumps(synthetic_data(1600000000, udp=True)).encode('utf-8'),
+                    json.dumps({'data': synthetic_data(1600000000), 'error': None}).encode('utf-8')]
+    if not payloads:
+        print('No payloads in {}'.format(capture))
+        return
+
+    number = max(count // len(payloads), 1)
+    for name, loads in JSON_BACKENDS.items():
+        timer = timeit.Timer(lambda: [loads(payload) for payload in payloads])
+        elapsed = min(timer.repeat(repeat, number))
+        print('{:8} {:.2f} us/datagram'.format(name, elapsed / (number * len(payloads)) * 1e6))
+    if 'json' in JSON_BACKENDS:
+        timer = timeit.Timer(lambda: [json.loads(payload.decode('utf-8')) for payload in payloads])
+        elapsed = min(timer.repeat(repeat, number))
+        print('{:8} {:.2f} us/datagram (decode to str first)'.format('json', elapsed / (number * len(payloads)) * 1e6))
+
+
+def run_benchmark(duration=60, speed=1.0, capture=None, udp_port=22222):
+    """Drive genLoopPackets() against a WllEmulator and print the packet rate,
+    the decode latency percentiles and the number of dropped datagrams."""
+    emulator = WllEmulator(udp_port=udp_port, speed=speed, capture=capture)
+    emulator.start(broadcast=False)
+
+    driver = WeatherLinkLiveUDPDriver(wll_ip='127.0.0.1', wll_port=emulator.http_port, udp_port=udp_port)
+    driver.open_udp_socket()
+    emulator.start_broadcast()
+
+    decode_times = []
+    counts = {'udp': 0, 'http': 0}
+    decode_data_wll = driver.station.decode_data_wll
+
+    def timed_decode(data, udp=False):
+        start = time.perf_counter()
+        packet = decode_data_wll(data, udp=udp)
+        decode_times.append(time.perf_counter() - start)
+        counts['udp' if udp else 'http'] += 1
+        return packet
 
+    driver.station.decode_data_wll = timed_decode
 
-def make_request_using_socket(url):
+    packets = 0
+    start = time.time()
     try:
-        retry_strategy = Retry(total=3, backoff_factor=1)
+        for _ in driver.genLoopPackets():
+            packets += 1
+            if time.time() - start >= duration or emulator.finished.is_set():
+                break
+    finally:
+        elapsed = time.time() - start
+        emulator.stop()
+        driver.closePort()
 
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        http = requests.Session()
-        http.mount("http://", adapter)
+    decode_times.sort()
 
-        resp = http.get(url, timeout=3)
+    def percentile(p):
+        if not decode_times:
+            return 0.0
+        return decode_times[min(len(decode_times) - 1, int(len(decode_times) * p / 100))] * 1e6
 
-        json_data = json.loads(resp.text)
-        if json_data["data"] is None:
-            logerr(json_data["error"])
-        else:
-            return json_data
-    except requests.Timeout as err:
-        logerr({"message": err})
-    except requests.RequestException as err:
-        # Max retries exceeded
-        logerr('Request Exception: {}'.format(err))
+    print('packets:            {} in {:.1f} s ({:.1f} packets/s)'.format(packets, elapsed, packets / elapsed))
+    print('UDP / HTTP decoded: {} / {}'.format(counts['udp'], counts['http']))
+    print('decode latency:     p50 {:.1f} us, p90 {:.1f} us, p99 {:.1f} us, max {:.1f} us'
+          .format(percentile(50), percentile(90), percentile(99), percentile(100)))
+    print('dropped datagrams:  {}'.format(max(emulator.sent - counts['udp'], 0)))
 
 
 # To test this driver, run it directly as follows:
@@ -529,8 +3031,6 @@ if __name__ == "__main__":
     import weeutil.logger
     import weewx
 
-    weewx.debug = 1
-    weeutil.logger.setup('WeatherLinkLiveUDP', {})
     usage = """Usage:%prog --wll_ip= [options] [--help] [--version]"""
 
     parser = optparse.OptionParser(usage=usage)
@@ -539,6 +3039,42 @@ if __name__ == "__main__":
     #
     parser.add_option('--wll_ip', dest='wll_ip', metavar='wll_ip',
                       help='ip address from Weather Link Live')
+    parser.add_option('--wll_port', dest='wll_port', type='int', default=80,
+                      help='HTTP port of the Weather Link Live')
+    parser.add_option('--bench-decode', dest='bench_decode', action='store_true',
+                      help='Measure the decode cost per packet')
+    parser.add_option('--bench-alloc', dest='bench_alloc', action='store_true',
+                      help='Measure the memory allocated per packet with tracemalloc, over --capture or a synthetic session')
+    parser.add_option('--bench-json', dest='bench_json', action='store_true',
+                      help='Measure the JSON parse cost per datagram (of --capture)')
+    parser.add_option('--emulate', dest='emulate', action='store_true',
+                      help='Run a local WLL emulator until interrupted')
+    parser.add_option('--benchmark', dest='benchmark', action='store_true',
+                      help='Run the driver against a local WLL emulator')
+    parser.add_option('--duration', dest='duration', type='float', default=60,
+                      help='Benchmark duration in seconds')
+    parser.add_option('--speed', dest='speed', type='float', default=1.0,
+                      help='Emulator speed, 0 is as fast as possible')
+    parser.add_option('--capture', dest='capture', metavar='FILE',
+                      help='Captured session to replay in the emulator')
+    parser.add_option('--replay', dest='replay', metavar='FILE',
+                      help='Decode a capture offline and print the packets')
+    parser.add_option('--backfill', dest='backfill', action='store_true',
+                      help='Decode the capture files given as arguments into the archive of --config')
+    parser.add_option('--config', dest='config', metavar='CONFIG_FILE',
+                      help='WeeWX configuration file to backfill, default is the standard location')
+    parser.add_option('--binding', dest='binding', default='wx_binding',
+                      help='Data binding to backfill, default is wx_binding')
+    parser.add_option('--archive-interval', dest='archive_interval', type='int',
+                      help='Archive interval in seconds, default is archive_interval of [StdArchive]')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=1000,
+                      help='Archive records per batch of inserts')
+    parser.add_option('--udp_port', dest='udp_port', type='int', default=22222,
+                      help='UDP broadcast port')
+    parser.add_option('--discover', dest='discover', action='store_true',
+                      help='Find the WLLs on the LAN and print what they report')
+    parser.add_option('--mdns', dest='mdns', metavar='HOST:PORT',
+                      help='Address of the mDNS queries, or where the emulator answers them')
 
     (options, args) = parser.parse_args()
 
@@ -546,6 +3082,75 @@ if __name__ == "__main__":
         print("Weatherlink Liver version %s" % DRIVER_VERSION)
         exit(0)
 
-    driver = WeatherLinkLiveUDPDriver()
+    weewx.debug = 0 if (options.bench_decode or options.bench_alloc or options.bench_json
+                        or options.benchmark or options.replay or options.backfill or options.discover) else 1
+    weeutil.logger.setup('WeatherLinkLiveUDP', {})
+
+    if options.bench_decode:
+        bench_decode()
+        exit(0)
+
+    if options.bench_alloc:
+        bench_alloc(options.capture)
+        exit(0)
+
+    if options.bench_json:
+        bench_json(options.capture)
+        exit(0)
+
+    if options.benchmark:
+        run_benchmark(options.duration, options.speed, options.capture, options.udp_port)
+        exit(0)
+
+    if options.replay:
+        station = WllStation(None)
+        start = time.time()
+        count = 0
+        for packet in replay_capture(station, options.replay):
+            count += 1
+            print(weeutil.weeutil.timestamp_to_string(packet['dateTime']), packet)
+        print('Decoded {} packets in {:.2f} s'.format(count, time.time() - start))
+        exit(0)
+
+    if options.backfill:
+        if not args:
+            parser.error('--backfill needs one or more capture files')
+        packets, records = backfill(options.config, args, binding=options.binding,
+                                    interval=options.archive_interval, batch_size=options.batch_size)
+        print('{} packets, {} archive records'.format(packets, records))
+        exit(0)
+
+    if options.discover:
+        mdns_address = MDNS_ADDRESS
+        if options.mdns:
+            host, _, port = options.mdns.rpartition(':')
+            mdns_address = (host, int(port))
+        http = WllHttpClient(retries=0)
+        devices = discover(udp_port=options.udp_port, mdns_address=mdns_address)
+        for device in devices:
+            profile = probe(http, device['address'], device['port'])
+            print('{} at {}:{}'.format(device['name'], device['address'], device['port']))
+            print('    {}'.format(profile.describe() if profile else 'does not answer'))
+        print('Found {} Weatherlink Live'.format(len(devices)))
+        exit(0)
+
+    if options.emulate:
+        emulator = WllEmulator(http_port=options.wll_port, udp_port=options.udp_port,
+                               speed=options.speed, capture=options.capture,
+                               mdns_port=int(options.mdns.rpartition(':')[2]) if options.mdns else None)
+        emulator.start()
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            emulator.stop()
+        exit(0)
+
+    stn_dict = {'wll_port': options.wll_port, 'udp_port': options.udp_port}
+    if options.wll_ip:
+        stn_dict['wll_ip'] = options.wll_ip
+    if options.mdns:
+        stn_dict['mdns_address'] = options.mdns
+    driver = WeatherLinkLiveUDPDriver(**stn_dict)
     for packet in driver.genLoopPackets():
         print(weeutil.weeutil.timestamp_to_string(packet['dateTime']), packet)
@@ -0,0 +1,69 @@
+import os
+import random
+import socket
+import sys
+
+import pytest
+
+# The driver is installed as user.weatherlinkliveudp in the bin directory of WeeWX
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin'))
+
+from user import weatherlinkliveudp  # noqa: E402
+
+
+def pytest_addoption(parser):
+    parser.addoption('--seed', type=int, default=None,
+                     help='Seed of the random sessions, to reproduce a failure')
+    parser.addoption('--record-baseline', action='store_true', default=False,
+                     help='Write the measured costs to perf_baseline.json instead of checking them')
+
+
+@pytest.fixture(scope='session')
+def seed(request):
+    seed = request.config.getoption('--seed')
+    return random.randrange(1 << 32) if seed is None else seed
+
+
+@pytest.fixture
+def rng(request, seed):
+    """A random generator per test, reproducible with --seed=<the seed of the failing run>."""
+    print('seed {}'.format(seed))
+    return random.Random('{}-{}'.format(seed, request.node.name))
+
+
+@pytest.fixture
+def synthetic_data():
+    return weatherlinkliveudp.synthetic_data
+
+
+@pytest.fixture
+def station(synthetic_data):
+    """A station set up from a current_conditions record at noon."""
+    station = weatherlinkliveudp.WllStation(None)
+    station.set_up_station(synthetic_data(noon(), rainfall_daily=5))
+    return station
+
+
+@pytest.fixture
+def udp_port():
+    """A free UDP port on localhost."""
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+@pytest.fixture
+def emulator(udp_port):
+    """A WLL emulator on localhost that broadcasts every 10 ms once start_broadcast() is called."""
+    emulator = weatherlinkliveudp.WllEmulator(udp_port=udp_port, interval=0.01)
+    emulator.start(broadcast=False)
+    yield emulator
+    emulator.stop()
+
+
+def noon(ts=1700000000):
+    """Local noon of the day of ts."""
+    day = weatherlinkliveudp.datetime.date.fromtimestamp(ts)
+    return int(weatherlinkliveudp.time.mktime(day.timetuple())) + 12 * 3600
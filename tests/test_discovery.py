@@ -0,0 +1,19 @@
+import json
+import time
+
+from user.weatherlinkliveudp import WeatherLinkLiveUDPDriver
+
+
+def test_broadcast_of_moved_unit(emulator, synthetic_data):
+    driver = WeatherLinkLiveUDPDriver(wll_ip='127.0.0.1', wll_port=emulator.http_port, udp_port=emulator.udp_port)
+    station = driver.station
+    # As if set up with wll_ip = auto
+    station.discovery = {'timeout': 0, 'udp_port': None, 'mdns_address': ('127.0.0.1', 9)}
+    data = synthetic_data(time.time(), udp=True)
+    assert driver.source_station('127.0.0.2', json.dumps(data).encode('utf-8')) is station
+    assert station.moved_to == '127.0.0.2'
+
+    data['did'] = '001D0A7FFFFF'
+    assert driver.source_station('127.0.0.3', json.dumps(data).encode('utf-8')) is None
+    assert driver.source_station('127.0.0.3', b'not json') is None
+    assert station.moved_to == '127.0.0.2'
@@ -0,0 +1,112 @@
+"""Per packet costs against the baseline in perf_baseline.json.
+
+Every cost is divided by the cost of a reference workload timed in the same
+run, a plain Python copy of a data record into a dict, so the baseline holds
+for slower and faster hosts alike. A test fails when a ratio is more than
+margin times its baseline. Record a new baseline with --record-baseline when
+the decoder gets faster, or for a JSON backend that has none yet.
+"""
+import json
+import os
+import time
+import timeit
+
+import pytest
+
+from user import weatherlinkliveudp
+from user.weatherlinkliveudp import WeatherLinkLiveUDPDriver, measure_decode
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perf_baseline.json')
+
+
+@pytest.fixture(scope='module')
+def baseline(request):
+    with open(BASELINE_FILE) as baseline_file:
+        baseline = json.load(baseline_file)
+    yield baseline
+    if request.config.getoption('--record-baseline'):
+        with open(BASELINE_FILE, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=4, sort_keys=True)
+            baseline_file.write('\n')
+
+
+@pytest.fixture
+def check(request, baseline):
+    """check(ratio, key, ...) compares ratio with baseline[key]..., or records it."""
+    record = request.config.getoption('--record-baseline')
+
+    def check(ratio, *keys):
+        entry = baseline
+        for key in keys[:-1]:
+            entry = entry.setdefault(key, dict())
+        if record:
+            entry[keys[-1]] = round(ratio, 2)
+        elif keys[-1] not in entry:
+            pytest.skip('no baseline for {}, record one with --record-baseline'.format('.'.join(keys)))
+        else:
+            assert ratio <= entry[keys[-1]] * baseline['margin'], keys
+    return check
+
+
+def reference_cost(synthetic_data, count=5000):
+    """The cost in us of copying the fields of a data record into a new dict."""
+    data = synthetic_data(1600000000)
+    conditions = data['conditions']
+
+    def copy():
+        packet = {'dateTime': data['ts'], 'usUnits': 1}
+        for condition in conditions:
+            for key, value in condition.items():
+                if value is not None:
+                    packet[key] = value
+        return packet
+
+    return min(timeit.Timer(copy).repeat(5, count)) / count * 1e6
+
+
+def relative(synthetic_data, measure):
+    """The costs of measure() divided by the reference cost, the best of the
+    ones timed right before and after it, as the clock of the CPU may change."""
+    before = reference_cost(synthetic_data)
+    costs = measure()
+    reference = min(before, reference_cost(synthetic_data))
+    return dict((key, cost / reference) for key, cost in costs.items())
+
+
+def test_decode_cost(synthetic_data, check):
+    ratios = relative(synthetic_data, lambda: measure_decode(count=5000))
+    check(ratios['HTTP'], 'decode_http')
+    check(ratios['UDP'], 'decode_udp')
+
+
+@pytest.mark.parametrize('backend', ('json', 'orjson', 'ujson'))
+def test_json_parse_cost(synthetic_data, check, backend):
+    if backend not in weatherlinkliveudp.JSON_BACKENDS:
+        pytest.skip('{} is not installed'.format(backend))
+    loads = weatherlinkliveudp.JSON_BACKENDS[backend]
+    payload = json.dumps(synthetic_data(1600000000, udp=True)).encode('utf-8')
+    ratios = relative(synthetic_data, lambda: {'parse': min(timeit.Timer(lambda: loads(payload)).repeat(5, 5000))
+                                               / 5000 * 1e6})
+    check(ratios['parse'], 'json_parse', backend)
+
+
+def test_loop_latency(emulator, udp_port, synthetic_data, check):
+    """90th percentile from datagram arrival to yield in the driver loop. A
+    higher one would measure the scheduler of the host rather than the loop."""
+    driver = WeatherLinkLiveUDPDriver(wll_ip='127.0.0.1', wll_port=emulator.http_port, udp_port=udp_port)
+    driver.open_udp_socket()
+    emulator.start_broadcast()
+
+    def measure():
+        start = time.time()
+        try:
+            for _ in driver.genLoopPackets():
+                if time.time() - start >= 3:
+                    break
+        finally:
+            driver.closePort()
+        latency = driver.stats.udp_yield_latency
+        assert latency.count
+        return {'p90': latency.percentile(90) * 1e6}
+
+    check(relative(synthetic_data, measure)['p90'], 'loop_p90')
@@ -0,0 +1,35 @@
+from user.weatherlinkliveudp import QualityFilter
+
+
+def test_spikes_and_ranges(rng):
+    """A random walk of temperatures with spikes and one step."""
+    quality = QualityFilter()
+    temp = 60.0
+    samples = 2000
+    step = samples // 2
+    for index in range(samples):
+        ts = index * 10
+        temp += rng.uniform(-0.2, 0.2)
+        if index == step:
+            # A sensor swap: a new level that has to be accepted
+            temp += 30
+        spike = index % 97 == 50
+        packet = {'dateTime': ts, 'outTemp': temp + 40 if spike else temp, 'outHumidity': None, 'UV': 99}
+        quality.check(ts, packet)
+        assert 'UV' not in packet
+        assert 'outHumidity' in packet
+        if spike:
+            assert 'outTemp' not in packet, index
+        elif index > step + quality.max_rejects:
+            assert 'outTemp' in packet, index
+
+
+def test_rain_rate_is_range_checked(station, synthetic_data):
+    station.quality = QualityFilter()
+    data = synthetic_data(station.rainbarrel.previous_date_stamp - 3600)
+    data['conditions'][0]['rain_rate_last'] = 100000
+    data['conditions'][0]['temp'] = 500
+    packet = station.decode_data_wll(data)
+    assert 'rainRate' not in packet
+    assert 'outTemp' not in packet
+    assert 'outHumidity' in packet
@@ -0,0 +1,217 @@
+import datetime
+import time
+
+import pytest
+
+from user.weatherlinkliveudp import MidnightWindow, PacketCoalescer, WeatherLinkLiveUDPDriver, WllStation
+
+
+def random_session(rng, synthetic_data, start, records=400):
+    """Random (ts, source, data, restart) records of a WLL with an ISS, in the
+    order the driver handles them.
+
+    UDP every 2.5 s and HTTP every 10 s, with rain showers, midnights and
+    downtimes of up to two days after which the driver is restarted. The
+    first record after a restart is an HTTP response, like the first poll of
+    the driver. The daily rain counter starts at 0 at local midnight, and is
+    sometimes reset by a reboot of the WLL. Some HTTP responses are handled
+    after the next UDP datagram, as they come from the poller thread.
+    """
+    timeline = []
+    ts = start
+    counter = rng.randint(0, 50)
+    day = datetime.date.fromtimestamp(ts)
+    restart = False
+    for index in range(records):
+        reboot = False
+        if index and rng.random() < 0.01:
+            ts += rng.randint(60, 2 * 86400)
+            restart = True
+            if rng.random() < 0.3:
+                counter = 0
+                reboot = True
+        elif rng.random() < 0.05:
+            # Straight to around midnight; the WLL clock does not go back
+            midnight = time.mktime((datetime.date.fromtimestamp(ts) + datetime.timedelta(days=1)).timetuple())
+            ts = max(ts + 2.5, midnight + rng.choice((-10, -5, -2.5, 0, 2.5)))
+        else:
+            ts += 2.5
+        if datetime.date.fromtimestamp(ts) != day:
+            day = datetime.date.fromtimestamp(ts)
+            counter = 0
+            reboot = True
+        elif rng.random() < 0.005:
+            # The WLL rebooted
+            counter = 0
+            reboot = True
+        if rng.random() < 0.2:
+            counter += rng.randint(1, 3)
+
+        udp = not restart and index % 4 != 0
+        data = synthetic_data(int(ts) if not udp else ts, udp=udp, rainfall_daily=counter)
+        timeline.append([ts, 'udp' if udp else 'http', data, restart, reboot])
+        restart = False
+
+    # Hand an HTTP response over after the datagram that follows it 2.5 s
+    # later, once. Not the first contact at startup, not across a restart, and
+    # not across a counter reset: the rain of the stale response is then only
+    # in that response.
+    index = 1
+    while index < len(timeline) - 1:
+        record, following = timeline[index], timeline[index + 1]
+        if (record[1] == 'http' and following[1] == 'udp' and following[0] - record[0] <= 2.5
+                and not record[3] and not following[3] and not record[4] and not following[4]
+                and rng.random() < 0.3):
+            timeline[index], timeline[index + 1] = following, record
+            index += 1
+        index += 1
+    for ts, source, data, restart, _ in timeline:
+        yield ts, source, data, restart
+
+
+def expected_rain(records):
+    """The rain (buckets) in a sequence of (ts, daily counter) records, in time order.
+
+    The first record is the baseline. A counter that went back on the same
+    day is the new baseline, see WllStation.calculate_rain().
+    """
+    total = 0
+    previous = None
+    for ts, counter in sorted(records):
+        day = datetime.date.fromtimestamp(ts)
+        if previous is not None:
+            if day != previous[0]:
+                total += counter
+            elif counter >= previous[1]:
+                total += counter - previous[1]
+        previous = (day, counter)
+    return total
+
+
+def run_session(rng, synthetic_data, state_file):
+    """Run a random session through the decoder, with restarts, as the driver does.
+    Returns (records, buckets emitted, buckets after coalescing, buckets pending)."""
+    records = []
+    station = None
+    coalescer = PacketCoalescer(window=10)
+    emitted = 0.0
+    coalesced = 0.0
+    now = 0.0
+
+    for ts, source, data, restart in random_session(rng, synthetic_data, rng.randint(1500000000, 1800000000)):
+        if station is not None and restart and station.rainbarrel.dirty:
+            # What closePort() does at shutdown
+            station.rainbarrel.save_state()
+        if station is None or restart:
+            # What add_station() does at startup
+            station = WllStation(None)
+            station.rainbarrel.state_file = state_file
+            if station.rainbarrel.load_state():
+                station.set_txid(station.rainbarrel.txid)
+                station.build_decoder()
+                station.reconcile_pending = True
+            else:
+                station.set_up_station(data)
+        if source == 'http' and station.reconcile_pending:
+            station.reconcile(data)
+
+        records.append((data['ts'], data['conditions'][0]['rainfall_daily']))
+        udp = source == 'udp'
+        packet = station.decode_data_wll(data, udp=udp)
+        rain = packet.get('rain', 0) / station.rainbarrel.bucketsize
+        assert rain > -1e-9, 'negative rain at {}'.format(ts)
+        assert packet['dateTime'] == data['ts']
+        if udp:
+            assert 'outTemp' not in packet
+        else:
+            assert 'outTemp' in packet
+        emitted += rain
+
+        now += rng.choice((0.5, 2.5, 10))
+        merged = coalescer.add(packet, udp=udp, now=now)
+        if merged is not None:
+            coalesced += merged['rain'] / station.rainbarrel.bucketsize
+
+    return records, emitted, coalesced, coalescer.rain / station.rainbarrel.bucketsize
+
+
+@pytest.mark.parametrize('session', range(50))
+def test_random_session_counts_rain_once(rng, synthetic_data, tmp_path, session):
+    state_file = str(tmp_path / 'weatherlinkliveudp.state')
+    records, emitted, coalesced, pending = run_session(rng, synthetic_data, state_file)
+    assert emitted == pytest.approx(expected_rain(records))
+    assert coalesced + pending == pytest.approx(emitted)
+
+
+def test_http_after_newer_udp_counts_once(station, synthetic_data):
+    # The HTTP response of start + 2 is handled after the datagram of start + 2.5
+    start = station.rainbarrel.previous_date_stamp - 12 * 3600
+    rain = 0
+    for ts, udp, counter in ((start + 2.5, True, 6), (start + 2, False, 5),
+                             (start + 5, True, 6), (start + 7.5, True, 7)):
+        packet = station.decode_data_wll(synthetic_data(ts, udp=udp, rainfall_daily=counter), udp=udp)
+        rain += packet.get('rain') or 0
+    assert rain / station.rainbarrel.bucketsize == pytest.approx(2)
+
+
+
+@pytest.mark.parametrize('step', (-3600, -86400))
+def test_clock_going_back_counts_rain(station, synthetic_data, step):
+    # A WLL clock, or a saved state, that was ahead
+    start = station.rainbarrel.previous_date_stamp - 6 * 3600
+    rain = 0
+    for ts, counter in ((start, 5), (start + step, 6), (start + step + 2.5, 8), (start + step + 1, 8)):
+        packet = station.decode_data_wll(synthetic_data(ts, udp=True, rainfall_daily=counter), udp=True)
+        rain += packet['rain']
+    assert rain / station.rainbarrel.bucketsize == pytest.approx(3)
+    assert station.stats.counters['rain_records_stale'] == 1
+
+
+def test_rain_tip_is_checkpointed_later(station, synthetic_data, tmp_path):
+    state_file = tmp_path / 'weatherlinkliveudp.state'
+    station.rainbarrel.state_file = str(state_file)
+    station.rainbarrel.save_state()
+    saved = state_file.read_text()
+    start = station.rainbarrel.previous_date_stamp - 12 * 3600
+    station.decode_data_wll(synthetic_data(start + 2.5, udp=True, rainfall_daily=6), udp=True)
+    # No disk access on the receive path
+    assert state_file.read_text() == saved
+    station.rainbarrel.flush()
+    assert state_file.read_text() == saved
+    station.rainbarrel.flush(now=station.rainbarrel.next_save)
+    assert '"rain_previous_period": 6' in state_file.read_text()
+    assert not station.rainbarrel.dirty
+
+
+def test_reboot_counts_from_new_counter(station, synthetic_data):
+    start = station.rainbarrel.previous_date_stamp - 12 * 3600
+    packet = station.decode_data_wll(synthetic_data(start + 10, udp=True, rainfall_daily=0), udp=True)
+    assert packet['rain'] == 0
+    packet = station.decode_data_wll(synthetic_data(start + 12.5, udp=True, rainfall_daily=1), udp=True)
+    assert packet['rain'] / station.rainbarrel.bucketsize == pytest.approx(1)
+
+
+def test_midnight_window(rng):
+    start = rng.randint(1500000000, 1800000000)
+    window = MidnightWindow(5)
+    window.update(start)
+    ts = start
+    for _ in range(2000):
+        ts += rng.choice((0.5, 1, 2.5, 30, 3600, 40000))
+        midnight = time.mktime(datetime.date.fromtimestamp(ts).timetuple())
+        assert window.contains(ts) == (ts - midnight < window.duration), ts
+
+
+def test_out_of_order_http_goes_with_next_packet(emulator, synthetic_data):
+    driver = WeatherLinkLiveUDPDriver(wll_ip='127.0.0.1', wll_port=emulator.http_port, udp_port=emulator.udp_port)
+    station = driver.station
+    start = int(time.time()) + 10
+    times = []
+    for ts, udp, counter in ((start + 2.5, True, 6), (start + 2, False, 7), (start + 5, True, 7)):
+        packet = station.decode_data_wll(synthetic_data(ts, udp=udp, rainfall_daily=counter), udp=udp)
+        packet = driver.finish_packet(station, packet, udp=udp)
+        if packet is not None:
+            times.append(packet['dateTime'])
+    assert times == sorted(times) == [start + 2.5, start + 5]
+    assert 'outTemp' in packet
+    assert driver.stats.counters['packets_out_of_order'] == 1